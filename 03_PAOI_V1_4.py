@@ -1,25 +1,51 @@
 import os
+import sys
 import csv
 import json
 import re
 import shutil
+import sqlite3
+import argparse
 import threading
+import signal
+import queue
+import struct
+import ctypes
+import ctypes.util
+import io
+import contextlib
+import random
+import gzip
+import lzma
+import tarfile
+import itertools
+import operator
+import atexit
+import functools
+import http.server
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, BrokenExecutor, as_completed
 import time
 import logging
+import logging.handlers
 import requests
+from requests.adapters import HTTPAdapter
 import schedule
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, Counter, OrderedDict
+
+# Optional: zstd compression for the Backup_Folder/Done_Folder archives (pip install zstandard)
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 # Define the password for reset (retrieve from environment variable for security)
 RESET_PASSWORD = os.getenv('RESET_PASSWORD', 'Kayneskt01')  # Changes based on plant - WIN - set RESET_PASSWORD=anypassword
 
-# Configure logging
+# Configure logging (see Logging section)
 log_file_path = os.path.join(os.path.dirname(__file__), 'Pre_AOI_app.log')
-logging.basicConfig(filename=log_file_path, 
-                    level=logging.INFO, 
-                    format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Get the current directory of the app
 current_directory = os.path.dirname(os.path.abspath(__file__))
@@ -31,6 +57,8 @@ folders = {
     "Backup_Folder": os.path.join(current_directory, "Backup_Folder"),
     "Logs_Folder": os.path.join(current_directory, "Logs_Folder"),
     "Done_Folder": os.path.join(current_directory, "Done_Folder"),  # Added cmd.py_10
+    "State_Folder": os.path.join(current_directory, "State_Folder"),
+    "Archive_Folder": os.path.join(current_directory, "Archive_Folder"),
 }
 
 # Defining log files in Logs_Folder
@@ -39,8 +67,111 @@ log_folders = {
     "Backup_Logs": os.path.join(folders["Logs_Folder"], "Backup_Logs"),
     "Parser_Logs": os.path.join(folders["Logs_Folder"], "Parser_Logs"),
     "Skipped_Logs": os.path.join(folders["Logs_Folder"], "Skipped_Logs"),
+    "Metrics_Logs": os.path.join(folders["Logs_Folder"], "Metrics_Logs"),
+}
+
+# Tunable settings. Keys of the same name in config.json override these defaults
+settings = {
+    "Watch_Mode": False,  # Process machine files as soon as they are written (see Watch section)
+    "Pipeline_Mode": True,  # Run copy, parse and upload as separate stages (see Pipeline section); False runs task_workflow
+    "Pipeline_Queue_Size": 2,  # Hand-offs waiting between two stages before the earlier stage waits
+    "Pipeline_Drain_Seconds": 120,  # On STOP, how long to let the stages finish work already started
+    "Headless": False,  # Start without any console prompt or STOP/RESET console (e.g. at boot); stop with SIGTERM
+    "Schedule_Minutes": 0,  # Cycle interval; 0 asks at startup (headless runs use 10)
+    "Adaptive_Schedule": True,  # Shorten the interval while files are backing up, lengthen it while the line is idle
+    "Schedule_Min_Minutes": 1,  # Shortest interval the adaptive schedule uses
+    "Schedule_Max_Minutes": 30,  # Longest interval the adaptive schedule uses
+    "Copy_Quiet_Seconds": 5,  # A machine file is copied only after its size and mtime were stable this long
+    "Copy_Watermark_Slack_Seconds": 3600,  # Files this much older than the copy watermark are still re-checked
+    "Copy_Workers": 4,  # Parallel file copies from the machine folder (often a network or USB mount)
+    "Copy_Batch_Size": 50,  # Copied files recorded in the ledger per commit
+    "Staging_JSON_Pretty": False,  # Indent the JSON_Data_Folder files (larger and slower to write)
+    "Parse_Workers": 4,  # Worker processes reading CSVs in parallel; 1 parses serially
+    "Parse_Parallel_Min_Files": 20,  # Smaller batches are parsed serially (not worth the hand-off)
+    "PD_Block_Size": 100,  # PD numbers reserved per state database update
+    "PD_Number_Width": 4,  # Minimum digits of a PD number (PD0001)
+    "LM_Refresh_Min_Seconds": 10,  # Parses this soon after an LM folder scan reuse it (one scan per tick for all lines)
+    "Skip_Retry_Base_Seconds": 300,  # First retry of a skipped CSV without new laser marking data; doubles per attempt
+    "Skip_Retry_Max_Seconds": 21600,  # Longest wait between such retries
+    "Archive_After_Days": 30,  # Backup_Folder/Done_Folder files older than this go into daily archives; 0 disables
+    "Archive_Compression": "auto",  # gz, xz, zst, or auto (zst if the zstandard package is installed, else gz)
+    "Archive_Interval_Minutes": 60,  # How often the background archiver looks for old files
+    "ERP_Pool_Size": 10,  # Keep-alive connections held open to the ERP server
+    "ERP_Connect_Timeout": 5,  # Seconds to wait for a connection to the ERP server
+    "ERP_Read_Timeout": 30,  # Seconds to wait for an ERP response when the call gives no timeout of its own
+    "ERP_Batch_Upsert": True,  # Merge a JSON file's records into the parent and send one PUT per chunk, not a GET+PUT per record
+    "ERP_Batch_Chunk_Size": 500,  # New records added to the parent per batched PUT (each PUT still carries the whole child table)
+    "Parent_Cache_TTL_Seconds": 3600,  # How long a model_id -> parent document name is reused without a lookup; 0 disables
+    "Parent_Cache_Size": 256,  # Most model_ids kept in that cache (least recently used are dropped)
+    "ERP_Breaker_Failures": 3,  # Consecutive connection errors/5xx from the ERP server that open the circuit (uploads parked)
+    "ERP_Breaker_Base_Seconds": 30,  # First wait before a probe request is let through an open circuit
+    "ERP_Breaker_Max_Seconds": 900,  # Longest wait between probes (the wait doubles after each failed probe, with jitter)
+    "Upload_Workers": 4,  # JSON files uploaded in parallel; files of the same model_id are always sent one after another
+    "Metrics_Port": 0,  # Serve Prometheus metrics on http://Metrics_Host:Metrics_Port/metrics; 0 disables
+    "Metrics_Host": "127.0.0.1",  # Interface of the metrics endpoint (keep it local unless a scraper needs it)
+    "Log_Level": "INFO",  # DEBUG also logs every file and record (off in production; see Logging section)
+    "Log_Max_Bytes": 10485760,  # Pre_AOI_app.log is rotated at this size
+    "Log_Backup_Count": 5,  # Rotated log files kept (Pre_AOI_app.log.1 ... .5)
+    "Quiet_Console": False,  # Show only warnings and errors on the console (the log file is unchanged)
 }
 
+# Function to apply config.json overrides to the settings
+def apply_settings(config):
+    for key in settings:
+        if key in config:
+            settings[key] = config[key]
+
+#--------------------------------------------------------------------------------------Logging---
+# Log records are handed to a queue and written by one background thread (QueueListener), so the workflow never
+# waits for the log file or the console. logging.* goes to Pre_AOI_app.log only; console.* goes to the console as
+# well. Per-file and per-record messages are DEBUG with lazy %s arguments: below Log_Level they cost one level check
+console = logging.getLogger("paoi.console")
+log_queue = queue.SimpleQueue()
+log_listener = None
+file_log_handler = None
+console_log_handler = None
+
+# Console handler writing to the current sys.stdout, like print (it may be redirected, or None without a console)
+class ConsoleLogHandler(logging.StreamHandler):
+    def emit(self, record):
+        self.stream = sys.stdout
+        if self.stream is not None:
+            super().emit(record)
+
+# Function to start the background log writer - the log file is rotated at Log_Max_Bytes
+def setup_logging():
+    global log_listener, file_log_handler, console_log_handler
+    file_log_handler = logging.handlers.RotatingFileHandler(log_file_path, maxBytes=settings["Log_Max_Bytes"],
+                                                            backupCount=settings["Log_Backup_Count"], encoding="utf-8")
+    file_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    console_log_handler = ConsoleLogHandler(sys.stdout)
+    console_log_handler.setFormatter(logging.Formatter('%(message)s'))
+    console_log_handler.addFilter(logging.Filter(console.name))
+    log_listener = logging.handlers.QueueListener(log_queue, file_log_handler, console_log_handler, respect_handler_level=True)
+
+    root_logger = logging.getLogger()
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(logging.INFO)
+    log_listener.start()
+    # Write out what is still queued when the program exits
+    atexit.register(log_listener.stop)
+
+# Function to apply the log settings from config.json and the command line (--debug, --quiet)
+def apply_log_settings(debug=False, quiet=False):
+    level = logging.DEBUG if debug else logging.getLevelName(str(settings["Log_Level"]).upper())
+    if not isinstance(level, int):
+        level = logging.INFO
+    logging.getLogger().setLevel(level)
+    # Connection-level chatter of the HTTP client stays out of the debug log
+    logging.getLogger("urllib3").setLevel(max(level, logging.INFO))
+    file_log_handler.maxBytes = settings["Log_Max_Bytes"]
+    file_log_handler.backupCount = settings["Log_Backup_Count"]
+    console_log_handler.setLevel(max(level, logging.WARNING) if quiet or settings["Quiet_Console"] else level)
+
+# Parse worker processes don't log to the file themselves (their errors come back with the parse results)
+if multiprocessing.parent_process() is None:
+    setup_logging()
+
 # Create folders. error handling added in cmd_3.py
 def create_folders():
     try:
@@ -50,8 +181,405 @@ def create_folders():
             os.makedirs(log_folder, exist_ok=True)
         logging.info("Folders created successfully.")
     except Exception as e:
-        logging.error(f"Error creating folders: {e}")
-        print(f"Error creating folders: {e}")
+        console.error(f"Error creating folders: {e}")
+
+# Local state database (SQLite) shared by the indexes that must survive a restart or STOP
+state_db_path = os.path.join(folders["State_Folder"], "pre_aoi_state.db")
+state_db_local = threading.local()
+
+# Production lines: one process can serve several AOI machines ("Lines" in config.json). Each line has its own
+# machine folder, its own JSON_Data/Scan/Backup/Done/Logs folders and its own state database (copy ledger, NG
+# counts, skip queue, outbox). The laser marking index, PD numbers, ERP connections, parse workers and upload
+# workers are shared. Without "Lines", Machine_Data_Folder and the folders above make up the one (default) line.
+# Code that works on line files runs inside line_context(line) and reads line_folders()/line_log_folders()
+LINE_FOLDER_NAMES = ("JSON_Data_Folder", "Scan_Folder", "Backup_Folder", "Logs_Folder", "Done_Folder", "State_Folder")
+default_line = {"name": "", "machine_data_folder": None, "folders": folders, "log_folders": log_folders,
+                "state_db_path": state_db_path, "upload_workers": 0}
+lines = [default_line]
+line_local = threading.local()
+
+# Helper function to build a line (plain data, so it can be handed to parse worker processes)
+def make_line(name, machine_data_folder, root_folder, upload_workers=0):
+    line_folder_paths = {folder_name: os.path.join(root_folder, folder_name) for folder_name in LINE_FOLDER_NAMES}
+    return {
+        "name": name,
+        "machine_data_folder": machine_data_folder,
+        "folders": line_folder_paths,
+        "log_folders": {log_name: os.path.join(line_folder_paths["Logs_Folder"], log_name) for log_name in log_folders},
+        "state_db_path": os.path.join(line_folder_paths["State_Folder"], "pre_aoi_state.db"),
+        "upload_workers": upload_workers,
+    }
+
+# Function to set up the lines from config.json - "Lines": [{"Name", "Machine_Data_Folder", "Folder" (optional,
+# default Lines/<Name>), "Upload_Workers" (optional)}]. Returns the lines
+def configure_lines(config, machine_data_folder):
+    line_configs = (config or {}).get("Lines") or []
+    if not line_configs:
+        default_line["machine_data_folder"] = machine_data_folder
+        lines[:] = [default_line]
+        return lines
+
+    configured = []
+    for line_config in line_configs:
+        name = line_config["Name"]
+        root_folder = line_config.get("Folder") or os.path.join(current_directory, "Lines", name)
+        line = make_line(name, line_config["Machine_Data_Folder"], root_folder, line_config.get("Upload_Workers", 0))
+        for folder in list(line["folders"].values()) + list(line["log_folders"].values()):
+            os.makedirs(folder, exist_ok=True)
+        configured.append(line)
+    if len({line["name"] for line in configured}) != len(configured):
+        raise ValueError("Line names in config.json must be unique")
+    # Upgrading from a single-line config: the line on the old Machine_Data_Folder (else the first one) carries on
+    # from the old copy ledger and Copy_Logs, so it doesn't copy and NG-count everything again
+    if os.path.exists(state_db_path):
+        same_folder = [line for line in configured if os.path.normcase(os.path.abspath(line["machine_data_folder"])) == os.path.normcase(os.path.abspath(machine_data_folder))]
+        seed_line_state((same_folder or configured)[0])
+    lines[:] = configured
+    logging.info(f"Serving {len(lines)} lines: {', '.join(line['name'] for line in lines)}")
+    return lines
+
+# Tables of the old single-line state database that a line carries on from (skip queue and outbox entries refer to
+# files in the old Scan_Folder and JSON_Data_Folder, which the line doesn't read)
+SEEDED_LINE_TABLES = ("copy_ledger", "copy_log_imports", "ng_counts", "copy_watermarks")
+
+# Function to seed a new line's state database and Copy_Logs from the single-line layout. Does nothing once the line
+# has a state database of its own
+def seed_line_state(line):
+    if os.path.exists(line["state_db_path"]):
+        return
+    old_copy_logs = log_folders["Copy_Logs"]
+    if os.path.isdir(old_copy_logs):
+        # copy_log_imports holds the sizes of these logs, so they move along with it
+        for log_file_name in os.listdir(old_copy_logs):
+            dest = os.path.join(line["log_folders"]["Copy_Logs"], log_file_name)
+            if not os.path.exists(dest):
+                shutil.copy2(os.path.join(old_copy_logs, log_file_name), dest)
+    os.makedirs(os.path.dirname(line["state_db_path"]), exist_ok=True)
+    get_shared_state_db()  # brings the old database up to date first
+    tmp_path = line["state_db_path"] + ".seed"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.executescript(STATE_DB_SCHEMA)
+        conn.execute("ATTACH DATABASE ? AS old", (state_db_path,))
+        with conn:
+            for table in SEEDED_LINE_TABLES:
+                conn.execute(f"INSERT OR IGNORE INTO main.{table} SELECT * FROM old.{table}")
+        conn.execute("DETACH DATABASE old")
+    finally:
+        conn.close()
+    os.replace(tmp_path, line["state_db_path"])
+    logging.info(f"Seeded line {line['name']} from the single-line copy ledger and Copy_Logs")
+    for folder_name in ("Scan_Folder", "JSON_Data_Folder"):
+        if os.path.isdir(folders[folder_name]) and os.listdir(folders[folder_name]):
+            logging.warning(f"{folders[folder_name]} still has files from the single-line layout - move them to the line's {folder_name} to process them")
+
+# Helper function to get the line the current thread works for
+def get_current_line():
+    return getattr(line_local, "line", default_line)
+
+# Context manager to work for a line in the current thread
+@contextlib.contextmanager
+def line_context(line):
+    previous = get_current_line()
+    line_local.line = line
+    try:
+        yield line
+    finally:
+        line_local.line = previous
+
+# Helper function to get the folders of the current line
+def line_folders():
+    return get_current_line()["folders"]
+
+# Helper function to get the log folders of the current line
+def line_log_folders():
+    return get_current_line()["log_folders"]
+
+# Helper function to prefix a message with the current line's name (nothing for the default line)
+def line_label():
+    name = get_current_line()["name"]
+    return f"[{name}] " if name else ""
+
+STATE_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS lm_files (
+    path TEXT PRIMARY KEY,
+    folder_rank INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    model_id TEXT
+);
+CREATE TABLE IF NOT EXISTS lm_serials (
+    serial_no TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (serial_no, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS lm_serials_by_path ON lm_serials (path);
+CREATE TABLE IF NOT EXISTS copy_ledger (
+    file_name TEXT PRIMARY KEY,
+    copied_at TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS copy_log_imports (
+    log_name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS ng_counts (
+    serial_no TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS pd_allocator (
+    name TEXT PRIMARY KEY,
+    next_no INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS skip_queue (
+    csv_file TEXT PRIMARY KEY,
+    serial_no TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_attempt REAL NOT NULL,
+    next_attempt REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS skip_queue_by_serial ON skip_queue (serial_no);
+CREATE TABLE IF NOT EXISTS archive_members (
+    member_id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    archive TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    archived_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS archive_members_by_name ON archive_members (file_name);
+CREATE TABLE IF NOT EXISTS archive_serials (
+    serial_no TEXT NOT NULL,
+    member_id INTEGER NOT NULL,
+    PRIMARY KEY (serial_no, member_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS outbox_records (
+    json_file TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    serial_no TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (json_file, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS copy_watermarks (
+    src_folder TEXT PRIMARY KEY,
+    mtime REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+# Helper function to get this thread's connection to a state database file (SQLite connections are per thread)
+def open_state_db(path):
+    conns = getattr(state_db_local, "conns", None)
+    if conns is None:
+        conns = state_db_local.conns = {}
+    conn = conns.get(path)
+    if conn is None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(STATE_DB_SCHEMA)
+        migrate_state_db(conn)
+        conns[path] = conn
+    return conn
+
+# Function to bring a state database written by an earlier version up to date
+def migrate_state_db(conn):
+    # NG counters kept per copied file name become counters per serial (the file name up to the first underscore)
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'copy_log_names'").fetchone():
+        with conn:
+            conn.execute("INSERT INTO ng_counts (serial_no, count) "
+                         "SELECT CASE WHEN instr(file_name, '_') > 0 THEN substr(file_name, 1, instr(file_name, '_') - 1) ELSE file_name END, SUM(count) "
+                         "FROM copy_log_names WHERE true GROUP BY 1 "
+                         "ON CONFLICT (serial_no) DO UPDATE SET count = count + excluded.count")
+            conn.execute("DROP TABLE copy_log_names")
+
+# Function to get the state database of the current line (copy ledger, NG counts, skip queue, outbox)
+def get_state_db():
+    return open_state_db(get_current_line()["state_db_path"])
+
+# Function to get the state database shared by all lines (laser marking index, PD numbers, archive index)
+def get_shared_state_db():
+    return open_state_db(state_db_path)
+
+#--------------------------------------------------------------------------------------Metrics---
+# In-process metrics: stage latency histograms, counters (files, records, ERP responses, retries) and backlog
+# gauges, all labelled with the line. Served in Prometheus text format on Metrics_Port (localhost, off by
+# default), and summarised as one JSON line per cycle in Logs_Folder/Metrics_Logs
+METRIC_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+METRIC_HELP = {
+    "paoi_files_copied_total": "Machine files copied to Scan_Folder",
+    "paoi_files_parsed_total": "CSV files parsed into JSON_Data_Folder",
+    "paoi_files_skipped_total": "CSV files skipped (panel not in the laser marking data)",
+    "paoi_files_backed_up_total": "CSV files moved to Backup_Folder",
+    "paoi_records_parsed_total": "pre_aoi records parsed from CSV files",
+    "paoi_records_uploaded_total": "pre_aoi records accepted by the ERP server",
+    "paoi_records_failed_total": "pre_aoi record uploads not accepted (retried later)",
+    "paoi_json_files_done_total": "JSON files fully uploaded and moved to Done_Folder",
+    "paoi_erp_responses_total": "ERP requests by method and HTTP status (error: no response)",
+    "paoi_erp_retries_total": "ERP request retries",
+}
+metrics_lock = threading.Lock()
+metric_counters = Counter()  # (name, labels) -> value; labels is a sorted tuple of (label, value)
+stage_histograms = {}  # (stage, line) -> {"buckets": [...], "sum": seconds, "count": n}
+metrics_summaries = {}  # line -> totals at its last cycle summary
+metrics_server = None
+
+# Function to add to a counter of the current line
+def count_metric(name, amount=1, **labels):
+    if amount:
+        key = (name, tuple(sorted(dict(labels, line=get_current_line()["name"]).items())))
+        with metrics_lock:
+            metric_counters[key] += amount
+
+# Function to record the duration of one run of a stage for the current line
+def observe_stage(stage, seconds):
+    key = (stage, get_current_line()["name"])
+    with metrics_lock:
+        histogram = stage_histograms.get(key)
+        if histogram is None:
+            histogram = stage_histograms[key] = {"buckets": [0] * len(METRIC_BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(METRIC_BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+# Decorator to time every call of a function as a stage
+def timed_stage(stage):
+    def decorate(function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe_stage(stage, time.perf_counter() - started)
+        return timed
+    return decorate
+
+# Helper function to count the files waiting in the current line's Scan_Folder and JSON_Data_Folder
+def get_backlog_counts():
+    backlog = {}
+    for folder_key, suffix in (("Scan_Folder", ".csv"), ("JSON_Data_Folder", ".json")):
+        try:
+            with os.scandir(line_folders()[folder_key]) as entries:
+                backlog[folder_key] = sum(1 for entry in entries if entry.name.endswith(suffix))
+        except OSError:
+            backlog[folder_key] = 0
+    return backlog
+
+# Helper function to format Prometheus labels
+def format_metric_labels(labels):
+    parts = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+# Function to render all metrics in the Prometheus text format
+def render_metrics():
+    with metrics_lock:
+        counters = sorted(metric_counters.items())
+        histograms = sorted((key, dict(value, buckets=list(value["buckets"]))) for key, value in stage_histograms.items())
+
+    out = ["# HELP paoi_stage_seconds Time spent in each workflow stage",
+           "# TYPE paoi_stage_seconds histogram"]
+    for (stage, line), histogram in histograms:
+        labels = (("line", line), ("stage", stage))
+        for bound, count in zip(METRIC_BUCKETS, histogram["buckets"]):
+            out.append(f"paoi_stage_seconds_bucket{format_metric_labels(labels + (('le', bound),))} {count}")
+        out.append(f"paoi_stage_seconds_bucket{format_metric_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+        out.append(f"paoi_stage_seconds_sum{format_metric_labels(labels)} {histogram['sum']:.6f}")
+        out.append(f"paoi_stage_seconds_count{format_metric_labels(labels)} {histogram['count']}")
+
+    for name, help_text in METRIC_HELP.items():
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} counter")
+        out.extend(f"{name}{format_metric_labels(labels)} {value}" for (counter_name, labels), value in counters if counter_name == name)
+
+    out.append("# HELP paoi_backlog_files Files waiting in a line folder")
+    out.append("# TYPE paoi_backlog_files gauge")
+    for line in lines:
+        with line_context(line):
+            for folder_key, count in get_backlog_counts().items():
+                out.append(f"paoi_backlog_files{format_metric_labels((('folder', folder_key), ('line', line['name'])))} {count}")
+    out.append("# HELP paoi_erp_circuit_open 1 while ERP uploads are parked by the circuit breaker")
+    out.append("# TYPE paoi_erp_circuit_open gauge")
+    out.append(f"paoi_erp_circuit_open {int(is_erp_circuit_open())}")
+    return "\n".join(out) + "\n"
+
+# Helper function to get the current line's counter and stage totals (the base of a cycle summary)
+def get_line_metric_totals():
+    name = get_current_line()["name"]
+    totals = {"counters": Counter(), "stage_seconds": Counter()}
+    with metrics_lock:
+        for (counter_name, labels), value in metric_counters.items():
+            labels = dict(labels)
+            if labels.pop("line") == name:
+                suffix = "".join(f"_{value}" for _, value in sorted(labels.items()))
+                totals["counters"][counter_name[len("paoi_"):-len("_total")] + suffix] += value
+        for (stage, line_name), histogram in stage_histograms.items():
+            if line_name == name:
+                totals["stage_seconds"][stage] += histogram["sum"]
+    return totals
+
+# Function to write the JSON summary line of the current line's cycle: what happened since its previous summary
+def log_cycle_summary(mode, cycle_seconds=None):
+    line = get_current_line()
+    totals = get_line_metric_totals()
+    previous = metrics_summaries.get(line["name"], {"counters": Counter(), "stage_seconds": Counter()})
+    metrics_summaries[line["name"]] = totals
+    summary = {
+        "time": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "line": line["name"],
+        "mode": mode,
+        "cycle_seconds": None if cycle_seconds is None else round(cycle_seconds, 3),
+        "stage_seconds": {stage: round(seconds, 3) for stage, seconds in sorted((totals["stage_seconds"] - previous["stage_seconds"]).items())},
+        "counts": dict(sorted((totals["counters"] - previous["counters"]).items())),
+        "backlog": get_backlog_counts(),
+        "erp_circuit_open": is_erp_circuit_open(),
+    }
+    try:
+        with open(get_log_file_path("Metrics_Logs", datetime.now().strftime('%Y-%m-%d')), 'a') as f:
+            f.write(json.dumps(summary) + "\n")
+    except OSError as e:
+        logging.error(f"Error writing cycle summary: {e}")
+
+# Request handler of the metrics endpoint (GET /metrics)
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Function to start the metrics endpoint when Metrics_Port is set
+def start_metrics_server():
+    global metrics_server
+    if not settings["Metrics_Port"]:
+        return
+    try:
+        metrics_server = http.server.ThreadingHTTPServer((settings["Metrics_Host"], settings["Metrics_Port"]), MetricsRequestHandler)
+    except OSError as e:
+        console.error(f"Could not start the metrics endpoint on port {settings['Metrics_Port']}: {e}")
+        return
+    metrics_server.daemon_threads = True
+    threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+    console.info(f"Metrics: http://{settings['Metrics_Host']}:{settings['Metrics_Port']}/metrics")
 
 # Config file creation. Changed to JSON file in cmd_5.py
 def write_folder_paths_to_file(api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2):
@@ -64,7 +592,8 @@ def write_folder_paths_to_file(api_key, api_secret, erp_url, machine_data_folder
             "LM_JSON_FOLDER": json_folder1,
             "LM_BKP_JSON_FOLDER": json_folder2,
             "Folders": folders,
-            "Log_Folders": log_folders
+            "Log_Folders": log_folders,
+            **settings
         }
 
         config_file = os.path.join(current_directory, "config.json")
@@ -72,8 +601,7 @@ def write_folder_paths_to_file(api_key, api_secret, erp_url, machine_data_folder
             json.dump(config_data, f, indent=4)
         logging.info("Configuration file created.")
     except Exception as e:
-        logging.error(f"Failed to write configuration file: {e}")
-        print(f"Failed to write configuration file: {e}")
+        console.error(f"Failed to write configuration file: {e}")
 
 # Function to load inputs from the config file
 def load_inputs_from_file():
@@ -99,269 +627,777 @@ def get_inputs():
     logging.info("User Input Registered.")
     return api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2
 
-# File Mover Functionality with error handling
-def copy_new_files(src_folder, dest_folder, log_folder_path):
+# Copy ledger: every file name ever copied to Scan_Folder, kept in the state database (copy_ledger table).
+# The daily copy_logs_*.log files are still written for reference; older ones are imported once.
+# ng_counts keeps, per board serial (file name up to the first underscore), the number of copy log lines naming
+# it - the NG count (see ng_count_log).
+copy_ledger_imported = set()  # Copy_Logs folders already imported by this process
+COPY_LOG_PATTERN = re.compile(r"^copy_logs_\d{4}-\d{2}-\d{2}\.log$")
+
+# Helper function to add copy log lines to the NG counters
+def add_to_ng_counts(conn, file_names):
+    counts = Counter(file_name.split('_')[0] for file_name in file_names)
+    conn.executemany("INSERT INTO ng_counts (serial_no, count) VALUES (?, ?) "
+                     "ON CONFLICT (serial_no) DO UPDATE SET count = count + excluded.count", counts.items())
+
+# Function to import copy_logs_*.log files into the copy ledger and NG counters. Logs are append-only,
+# so only the bytes added since the last import are read
+def import_copy_logs_into_ledger(log_folder_path):
+    conn = get_state_db()
+    imported = dict(conn.execute("SELECT log_name, size FROM copy_log_imports"))
+    for log_file_name in sorted(os.listdir(log_folder_path)):
+        log_file_path = os.path.join(log_folder_path, log_file_name)
+        if not (os.path.isfile(log_file_path) and log_file_name.startswith("copy_logs_") and log_file_name.endswith(".log")):
+            continue
+        size = os.path.getsize(log_file_path)
+        imported_size = imported.get(log_file_name, 0)
+        if imported_size == size:
+            continue
+        if imported_size > size:
+            logging.warning(f"{log_file_name} shrank since it was imported. Reading it again; its NG counts may be overstated.")
+            imported_size = 0
+        log_date = log_file_name[len("copy_logs_"):-len(".log")]
+        with open(log_file_path, 'rb') as log_file:
+            log_file.seek(imported_size)
+            file_names = [line for line in log_file.read().decode().splitlines() if line]
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO copy_ledger (file_name, copied_at) VALUES (?, ?)",
+                             [(file_name, log_date) for file_name in file_names])
+            if COPY_LOG_PATTERN.match(log_file_name):
+                add_to_ng_counts(conn, file_names)
+            conn.execute("INSERT OR REPLACE INTO copy_log_imports (log_name, size) VALUES (?, ?)", (log_file_name, size))
+        logging.info(f"Imported {len(file_names)} entries from {log_file_name} into the copy ledger.")
+    copy_ledger_imported.add(log_folder_path)
+
+# Function to check the copy ledger for a file name
+def is_file_in_copy_ledger(file_name):
+    return get_state_db().execute("SELECT 1 FROM copy_ledger WHERE file_name = ?", (file_name,)).fetchone() is not None
+
+# Function to record a batch of copied files in the current date copy log (one write), then in the copy ledger
+# and NG counters (one commit). The log is marked imported in the same commit, so a restart doesn't count it twice
+def add_files_to_copy_ledger(file_names, log_folder_path):
+    if not file_names:
+        return
+    now = datetime.now()
+    log_file_name = f"copy_logs_{now.strftime('%Y-%m-%d')}.log"
+    current_log_file = os.path.join(log_folder_path, log_file_name)
+    with open(current_log_file, 'a') as log:
+        log.write("".join(f"{file_name}\n" for file_name in file_names))
+
+    conn = get_state_db()
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO copy_ledger (file_name, copied_at) VALUES (?, ?)",
+                         [(file_name, now.strftime('%Y-%m-%d %H:%M:%S')) for file_name in file_names])
+        add_to_ng_counts(conn, file_names)
+        conn.execute("INSERT OR REPLACE INTO copy_log_imports (log_name, size) VALUES (?, ?)",
+                     (log_file_name, os.path.getsize(current_log_file)))
+
+# Copy watermark: per source folder, the mtime below which every file has been handled. Scans skip
+# entries older than the watermark (less Copy_Watermark_Slack_Seconds) without consulting the ledger.
+# It never passes now - Copy_Quiet_Seconds, so a file dated in the future can't hide the files written after it
+# Lines copy on their own threads, so each line keeps its own observations
+copy_observations = defaultdict(dict)  # line name -> {source path -> (mtime, size, first seen)} while waiting for files to settle
+copy_observations_lock = threading.Lock()
+
+# Helper function to get the copy observations of the current line
+def get_copy_observations():
+    with copy_observations_lock:
+        return copy_observations[get_current_line()["name"]]
+
+# Function to get the persisted copy watermark of a source folder
+def get_copy_watermark(src_folder):
+    row = get_state_db().execute("SELECT mtime FROM copy_watermarks WHERE src_folder = ?", (src_folder,)).fetchone()
+    return row[0] if row else 0.0
+
+# Function to persist the copy watermark of a source folder
+def set_copy_watermark(src_folder, mtime):
+    conn = get_state_db()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO copy_watermarks (src_folder, mtime) VALUES (?, ?)", (src_folder, mtime))
+
+# Function to check that the machine has finished writing a file: unchanged for Copy_Quiet_Seconds, judged
+# by its mtime or, if the mount's clock is off, by our own observations of its size and mtime
+def is_file_stable(src_file_path, stat, now):
+    quiet = settings["Copy_Quiet_Seconds"]
+    observations = get_copy_observations()
+    observed = observations.get(src_file_path)
+    if observed is None or observed[:2] != (stat.st_mtime, stat.st_size):
+        observations[src_file_path] = (stat.st_mtime, stat.st_size, now)
+        return now - stat.st_mtime >= quiet and observed is None
+    return now - stat.st_mtime >= quiet or now - observed[2] >= quiet
+
+# Copy one file like shutil.copy2, letting the kernel move the data (os.copy_file_range, which can also
+# copy server-side on NFS/CIFS) where the filesystem allows it. The copy is written under a .part name
+# and renamed into place, so the parser never sees a half-copied file.
+def copy_file_fast(src_file_path, dest_file_path):
+    part_file_path = dest_file_path + ".part"
     try:
-        # Gather all copied file names from all logs in the Copy_Logs folder
-        copied_files = []
-        for log_file_name in os.listdir(log_folder_path):
-            log_file_path = os.path.join(log_folder_path, log_file_name)
-            if os.path.isfile(log_file_path) and log_file_name.startswith("copy_logs_") and log_file_name.endswith(".log"):
-                with open(log_file_path, 'r') as log_file:
-                    copied_files.extend(log_file.read().splitlines())
-        
-        # Get the list of files in the source folder
-        src_files = os.listdir(src_folder)
-        
-        # Copy files that haven't been logged
-        for file_name in src_files:
+        copied = False
+        if hasattr(os, "copy_file_range"):
+            with open(src_file_path, 'rb') as src, open(part_file_path, 'wb') as dest:
+                try:
+                    copied_bytes = 0
+                    while True:
+                        chunk = os.copy_file_range(src.fileno(), dest.fileno(), 1024 * 1024 * 1024)
+                        if not chunk:
+                            break
+                        copied_bytes += chunk
+                    # Some kernel/filesystem pairs (older cross-filesystem, some FUSE/CIFS mounts) return 0
+                    # without copying anything - only trust the kernel copy when every byte arrived
+                    copied = copied_bytes == os.fstat(src.fileno()).st_size
+                except OSError:
+                    # Not supported for this pair of filesystems - use the regular copy below
+                    pass
+        if not copied:
+            shutil.copyfile(src_file_path, part_file_path)
+        shutil.copystat(src_file_path, part_file_path)
+        os.replace(part_file_path, dest_file_path)
+    except BaseException:
+        if os.path.exists(part_file_path):
+            os.remove(part_file_path)
+        raise
+
+# Files copied (or being copied) into a Scan_Folder whose copy ledger and NG counts are not committed yet. The
+# parse stage leaves them alone, so it never reads a file's NG count before that file's copy is counted
+copy_in_flight = defaultdict(set)  # Scan_Folder path -> file names
+copy_in_flight_lock = threading.Lock()
+
+# Helper function to mark files as in flight (done=False) or committed to the copy ledger (done=True)
+def mark_copy_in_flight(dest_folder, file_names, done=False):
+    with copy_in_flight_lock:
+        if done:
+            copy_in_flight[dest_folder].difference_update(file_names)
+        else:
+            copy_in_flight[dest_folder].update(file_names)
+
+# Helper function to get the names of the files in a Scan_Folder that are still in flight
+def get_copy_in_flight(dest_folder):
+    with copy_in_flight_lock:
+        return set(copy_in_flight[dest_folder])
+
+# Helper function to list copy candidates - (name, stat) of the files not older than skip_before
+def scan_copy_candidates(src_folder, skip_before):
+    candidates = []
+    with os.scandir(src_folder) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                if stat.st_mtime >= skip_before:
+                    candidates.append((entry.name, stat))
+    return candidates
+
+# File Mover Functionality with error handling. Watch mode passes the file_names it saw instead of scanning src_folder.
+# Returns the names held back because they were still being written
+@timed_stage("copy")
+def copy_new_files(src_folder, dest_folder, log_folder_path, file_names=None):
+    deferred = []
+    try:
+        # Bring in copy logs written before the ledger existed (once per process)
+        if log_folder_path not in copy_ledger_imported:
+            import_copy_logs_into_ledger(log_folder_path)
+
+        now = time.time()
+        watermark_limit = now - settings["Copy_Quiet_Seconds"]
+        if file_names is None:
+            stored_watermark = watermark = get_copy_watermark(src_folder)
+            if watermark > now:
+                logging.warning(f"Copy watermark of {src_folder} is in the future ({datetime.fromtimestamp(watermark)}); scanning from now instead.")
+            watermark = min(watermark, watermark_limit)
+            candidates = scan_copy_candidates(src_folder, watermark - settings["Copy_Watermark_Slack_Seconds"])
+        else:
+            watermark = None
+            candidates = []
+            for file_name in file_names:
+                # A watched file may already be gone again by the time its batch runs
+                try:
+                    candidates.append((file_name, os.stat(os.path.join(src_folder, file_name))))
+                except OSError:
+                    continue
+
+        newest = watermark or 0.0
+        oldest_pending = None
+        future_files = 0
+
+        # Pick the files that haven't been logged and have finished being written
+        to_copy = []
+        for file_name, stat in candidates:
             src_file_path = os.path.join(src_folder, file_name)
-            dest_file_path = os.path.join(dest_folder, file_name)
-            
-            # Only copy if file_name is not in any of the logs
-            if file_name not in copied_files:
-                shutil.copy2(src_file_path, dest_file_path)
-                
-                # Log the newly copied file in the current date log file
-                current_log_file = os.path.join(log_folder_path, f"copy_logs_{datetime.now().strftime('%Y-%m-%d')}.log")
-                with open(current_log_file, 'a') as log:
-                    log.write(f"{file_name}\n")
-                
-                print(f"Copied {file_name} to {dest_folder}")
-                logging.info(f"Copied {file_name} to {dest_folder}")
-                
+
+            # Only copy if file_name is not in the copy ledger
+            if is_file_in_copy_ledger(file_name):
+                if stat.st_mtime <= now:
+                    newest = max(newest, stat.st_mtime)
+                continue
+
+            if not is_file_stable(src_file_path, stat, now):
+                deferred.append(file_name)
+                oldest_pending = stat.st_mtime if oldest_pending is None else min(oldest_pending, stat.st_mtime)
+                continue
+
+            to_copy.append((file_name, stat))
+
+        # Copy in parallel; the ledger is committed every Copy_Batch_Size files so a crash only recopies one batch.
+        # Until its batch is committed a copied file is in flight, and the parse stage doesn't pick it up
+        copied_batch = []
+        copied_count = 0
+        mark_copy_in_flight(dest_folder, [file_name for file_name, _ in to_copy])
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, settings["Copy_Workers"])) as pool:
+                futures = {pool.submit(copy_file_fast, os.path.join(src_folder, file_name), os.path.join(dest_folder, file_name)): (file_name, stat)
+                           for file_name, stat in to_copy}
+                for future in as_completed(futures):
+                    file_name, stat = futures[future]
+                    try:
+                        future.result()
+                    except OSError as e:
+                        # Holds the watermark back so the file is tried again next cycle
+                        console.error(f"Error copying {file_name}: {e}")
+                        oldest_pending = stat.st_mtime if oldest_pending is None else min(oldest_pending, stat.st_mtime)
+                        continue
+
+                    get_copy_observations().pop(os.path.join(src_folder, file_name), None)
+                    # A file dated in the future (machine clock ahead) is copied but doesn't move the watermark
+                    if stat.st_mtime <= now:
+                        newest = max(newest, stat.st_mtime)
+                    else:
+                        future_files += 1
+                    copied_batch.append(file_name)
+                    copied_count += 1
+                    console.debug("Copied %s to %s", file_name, dest_folder)
+
+                    if len(copied_batch) >= settings["Copy_Batch_Size"]:
+                        add_files_to_copy_ledger(copied_batch, log_folder_path)
+                        mark_copy_in_flight(dest_folder, copied_batch, done=True)
+                        copied_batch = []
+            add_files_to_copy_ledger(copied_batch, log_folder_path)
+        finally:
+            # Committed, failed, or (after an error) left for the next cycle to copy again
+            mark_copy_in_flight(dest_folder, [file_name for file_name, _ in to_copy], done=True)
+        count_metric("paoi_files_copied_total", copied_count)
+        if copied_count:
+            console.info(f"{line_label()}Copied {copied_count} file(s) to {dest_folder}")
+
+        if deferred:
+            logging.info(f"Waiting for {len(deferred)} file(s) in {src_folder} to finish writing.")
+        if future_files:
+            logging.warning(f"Copied {future_files} file(s) from {src_folder} with a modification time in the future - check the machine's clock.")
+
+        # Everything older than the oldest file still waiting has been handled
+        if watermark is not None:
+            # Forget observations of files that disappeared before they settled
+            candidate_paths = {os.path.join(src_folder, file_name) for file_name, _ in candidates}
+            src_dir = os.path.dirname(os.path.join(src_folder, ""))
+            observations = get_copy_observations()
+            for path in [path for path in observations if os.path.dirname(path) == src_dir and path not in candidate_paths]:
+                del observations[path]
+
+            new_watermark = newest if oldest_pending is None else min(newest, oldest_pending)
+            new_watermark = min(new_watermark, watermark_limit)
+            if new_watermark != stored_watermark:
+                set_copy_watermark(src_folder, new_watermark)
+
     except Exception as e:
-        logging.error(f"Error during file copying: {e}")
-        print(f"Error during file copying: {e}")
+        console.error(f"Error during file copying: {e}")
+    return deferred
 
 # Function to move only successfully parsed files to the backup folder, considering skipped files
 # If file exists, add a number at the end and copy it - CHANGED
+# successfully_parsed_files and skipped_files are the file names from this cycle's parse results (sets).
+# Moves are plain renames when both folders are on the same filesystem; the backup log is written once
+@timed_stage("backup")
 def move_files_to_backup(src_folder, backup_folder, backup_log_file, successfully_parsed_files, skipped_files):
     try:
-        # Check for files in the source folder
-        src_files = os.listdir(src_folder)
-        if not src_files:
+        to_move = set(successfully_parsed_files) - set(skipped_files)
+        if not to_move:
             logging.info(f"No files found in {src_folder} to move.")
             return
 
-        for file_name in src_files:
-            # Only move files that were successfully parsed and not skipped
-            if file_name in successfully_parsed_files and file_name not in skipped_files:
-                src_file_path = os.path.join(src_folder, file_name)
-                backup_file_path = os.path.join(backup_folder, file_name)
+        log_lines = []
+        for file_name in sorted(to_move):
+            src_file_path = os.path.join(src_folder, file_name)
+            backup_file_path = os.path.join(backup_folder, file_name)
 
+            try:
+                # Move the file
                 try:
-                    # Move the file
+                    os.replace(src_file_path, backup_file_path)
+                except OSError:
+                    # e.g. Backup_Folder on another filesystem
                     shutil.move(src_file_path, backup_file_path)
 
-                    # Log the move
-                    with open(backup_log_file, 'a') as log:
-                        log.write(f"{file_name} moved from {src_folder} to {backup_folder} on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-                    print(f"Moved {file_name} to {backup_folder}")
-                    logging.info(f"Backed up {file_name} to {backup_folder}")
-                except Exception as e:
-                    logging.error(f"Error moving {file_name}: {e}")
-            elif file_name in skipped_files:
-                logging.info(f"Skipped file {file_name} as it is in the skipped log.")
-                print(f"Skipped file {file_name} as it is in the skipped log.")
-    except Exception as e:
-        logging.error(f"Error during backup process: {e}")
-        print(f"Error during backup process: {e}")
+                log_lines.append(f"{file_name} moved from {src_folder} to {backup_folder} on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+                console.debug("Backed up %s to %s", file_name, backup_folder)
+            except Exception as e:
+                logging.error(f"Error moving {file_name}: {e}")
 
+        for file_name in sorted(set(skipped_files)):
+            console.debug("Skipped file %s as it is in the skipped log.", file_name)
 
-# Function to get the list of skipped files from the skipped log
-def get_skipped_files(log_file_path):
-    skipped_files = []
-    try:
-        # Check if the skipped files log exists
-        # print("Skipped_parsed_cheking")
-        if not os.path.exists(log_file_path):
-            logging.error(f"Skipped log file {log_file_path} does not exist.")
-            return skipped_files
-        
-        with open(log_file_path, 'r') as log_file:
-            for line in log_file:
-                # Check if the line indicates a skipped file
-                if "Skipped" in line:
-                    # Extract the csv filename from the log entry (last part of the path)
-                    parts = line.split(' ')
-                    if len(parts) > 1:
-                        file_name = parts[1].strip()  # The filename will be the second part of the log entry
-                        file_name_only = file_name.split('/')[-1]  # Get the file name without path
-                        skipped_files.append(file_name_only)
-    except Exception as e:
-        logging.error(f"Error reading skipped log file {log_file_path}: {e}")
-    return skipped_files
-
+        count_metric("paoi_files_backed_up_total", len(log_lines))
+        console.info(f"{line_label()}Backed up {len(log_lines)} file(s) to {backup_folder}; {len(set(skipped_files))} skipped file(s) stay in {src_folder}")
 
-# Function to read the parser log and extract successfully parsed filenames
-def get_successfully_parsed_files(log_file_path):
-    # print("Succefully_parsed_cheking")
-    parsed_files = []
-    try:
-        # Check if the log file exists before attempting to read it
-        if not os.path.exists(log_file_path):
-            logging.error(f"Log file {log_file_path} does not exist.")
-            return parsed_files
-        
-        with open(log_file_path, 'r') as log_file:
-            for line in log_file:
-                # Check if the line indicates a successful parse
-                if "parsed successfully" in line:
-                    # Extract the csv filename from the log entry (first part of the path)
-                    parts = line.split(' ')
-                    if len(parts) > 0:
-                        file_name = parts[0].strip()  # The filename will be the first part of the log entry
-                        file_name_only = file_name.split('/')[-1]  # Get the file name without path
-                        parsed_files.append(file_name_only)
+        # Log the moves
+        if log_lines:
+            with open(backup_log_file, 'a') as log:
+                log.write("".join(log_lines))
     except Exception as e:
-        logging.error(f"Error reading log file {log_file_path}: {e}")
-    return parsed_files
+        console.error(f"Error during backup process: {e}")
 
 #---------------------------------------------------------------------Parser----------
 
-# Function to check if the panel_barcode exists in JSON files within two folders
-def check_panel_barcode_in_json(serial_no, json_folder1, json_folder2, skipped_log_folder):
-    print("Entered Search")
-    
-    json_folders = [json_folder1, json_folder2]
-    
-    for folder in json_folders:
-        for json_file in os.listdir(folder):
-            if json_file.endswith(".json"):
-                json_file_path = os.path.join(folder, json_file)
-                print("Checking file:", json_file_path)
-                
+# Laser marking index, persisted in the state database (lm_files / lm_serials tables) and keyed by
+# serial_no. Each LM file's path, mtime and size are stored so a refresh - including the first one
+# after a restart - only re-reads the LM files that changed.
+lm_index_lock = threading.Lock()
+lm_index_state = {"scanned_at": None}  # monotonic time the last refresh started scanning the LM folders
+LM_INDEX_BATCH_SIZE = 500  # LM files committed per transaction, so an interrupted rebuild keeps its progress
+
+# Helper function to read one laser marking file - returns its model_id and serial numbers
+def read_lm_file(json_file_path):
+    with open(json_file_path, 'r') as f:
+        data = json.load(f)
+    serials = [entry.get("serial_no") for entry in data.get("laser_marking", [])]
+    return data.get("model_id"), tuple(dict.fromkeys(serial for serial in serials if serial))
+
+# Helper function to stat every LM file. Returns {path: (mtime, size, folder rank)} and the ranks of unreadable folders
+def scan_lm_folders(json_folder1, json_folder2):
+    seen = {}
+    failed_ranks = set()
+    for rank, folder in enumerate([json_folder1, json_folder2]):
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".json") and entry.is_file():
+                        stat = entry.stat()
+                        seen[entry.path] = (stat.st_mtime, stat.st_size, rank)
+        except OSError as e:
+            failed_ranks.add(rank)
+            logging.error(f"Error scanning laser marking folder {folder}: {e}")
+    return seen, failed_ranks
+
+# Function to bring the laser marking index up to date with both LM folders. With max_age, a refresh that
+# started scanning at most max_age seconds before this call is used as it is (the lines share one index, so
+# a tick's lines scan the LM folders once). Returns the number of LM files read and removed
+def refresh_lm_index(json_folder1, json_folder2, max_age=None):
+    requested = time.monotonic()
+    with lm_index_lock:
+        scanned_at = lm_index_state["scanned_at"]
+        if max_age is not None and scanned_at is not None and scanned_at >= requested - max_age:
+            return 0, 0
+        scan_started = time.monotonic()
+        conn = get_shared_state_db()
+        seen, failed_ranks = scan_lm_folders(json_folder1, json_folder2)
+        stored = {row[0]: tuple(row[1:]) for row in conn.execute("SELECT path, mtime, size, folder_rank FROM lm_files")}
+
+        # Keep what we already know about an unreachable folder instead of forgetting it
+        vanished = [path for path, stats in stored.items() if path not in seen and stats[2] not in failed_ranks]
+        changed = [path for path, stats in seen.items() if stored.get(path) != stats]
+
+        with conn:
+            for path in vanished:
+                conn.execute("DELETE FROM lm_serials WHERE path = ?", (path,))
+                conn.execute("DELETE FROM lm_files WHERE path = ?", (path,))
+
+        for start in range(0, len(changed), LM_INDEX_BATCH_SIZE):
+            batch = []
+            for path in changed[start:start + LM_INDEX_BATCH_SIZE]:
                 try:
-                    with open(json_file_path, 'r') as f:
-                        data = json.load(f)
-                        # Check if the serial_no exists in the JSON file's laser_marking list
-                        for entry in data.get("laser_marking", []):
-                            if entry.get("serial_no") == serial_no:
-                                print("Match found in file:", json_file_path)
-                                
-                                # Remove the CSV file from skipped logs
-                                remove_from_skipped_logs(skipped_log_folder, serial_no)
-                                
-                                return data.get("model_id"), True
+                    batch.append((path, *read_lm_file(path)))
                 except Exception as e:
-                    logging.error(f"Error reading JSON file {json_file_path}: {e}")
-                    print("Error reading JSON file:", json_file_path)
-    
-    return None, False
-
-def remove_from_skipped_logs(skipped_log_folder, serial_no):
-    try:
-        # Iterate through all log files in the folder
-        for log_file in os.listdir(skipped_log_folder):
-            if log_file.endswith(".log"):  # Assuming log files have .log extension
-                log_file_path = os.path.join(skipped_log_folder, log_file)
-                
-                # Read all lines from the log file
-                with open(log_file_path, 'r') as file:
-                    lines = file.readlines()
-                
-                # Filter out lines containing the serial_no
-                updated_lines = [line for line in lines if serial_no not in line]
-                
-                # Write the updated lines back to the log file
-                with open(log_file_path, 'w') as file:
-                    file.writelines(updated_lines)
-                
-                print(f"Removed {serial_no} from log file: {log_file_path}")
-    except Exception as e:
-        logging.error(f"Error updating skipped logs in folder {skipped_log_folder}: {e}")
-        print("Error updating skipped logs:", e)
-
-
-# Updated parse_csv_to_json function to capture and pass model_id
-def parse_csv_to_json(csv_file, json_file, log_file, model_id, json_folder1, json_folder2, skipped_log_file, skipped_log_folder):
+                    # Dropped without a new lm_files row, so a file caught mid-write is read again next refresh
+                    batch.append((path, None, None))
+                    console.error(f"Error reading JSON file {path}: {e}")
+
+            with conn:
+                for path, model_id, serials in batch:
+                    conn.execute("DELETE FROM lm_serials WHERE path = ?", (path,))
+                    conn.execute("DELETE FROM lm_files WHERE path = ?", (path,))
+                    if serials is None:
+                        continue
+                    mtime, size, rank = seen[path]
+                    conn.execute("INSERT INTO lm_files (path, folder_rank, mtime, size, model_id) VALUES (?, ?, ?, ?, ?)",
+                                 (path, rank, mtime, size, model_id))
+                    conn.executemany("INSERT OR IGNORE INTO lm_serials (serial_no, path) VALUES (?, ?)",
+                                     [(serial, path) for serial in serials])
+
+        lm_index_state["scanned_at"] = scan_started
+        logging.info(f"Laser marking index refreshed: {len(changed)} files read, {len(vanished)} removed.")
+        return len(changed), len(vanished)
+
+# Function to look up a serial_no in the laser marking index. LM_JSON_FOLDER wins over the backup folder
+def lookup_lm_serial(serial_no):
+    return get_shared_state_db().execute(
+        "SELECT f.model_id, f.path FROM lm_serials s JOIN lm_files f ON f.path = s.path "
+        "WHERE s.serial_no = ? ORDER BY f.folder_rank LIMIT 1", (serial_no,)).fetchone()
+
+# Function to rebuild the laser marking index from scratch (CLI: lm-index rebuild)
+def rebuild_lm_index(json_folder1, json_folder2):
+    conn = get_shared_state_db()
+    with conn:
+        conn.execute("DELETE FROM lm_serials")
+        conn.execute("DELETE FROM lm_files")
+    files_read, _ = refresh_lm_index(json_folder1, json_folder2)
+    console.info(f"Laser marking index rebuilt from {files_read} files.")
+
+# Function to check the laser marking index against the LM folders without changing it (CLI: lm-index verify)
+def verify_lm_index(json_folder1, json_folder2):
+    conn = get_shared_state_db()
+    seen, failed_ranks = scan_lm_folders(json_folder1, json_folder2)
+    stored = {row[0]: tuple(row[1:]) for row in conn.execute("SELECT path, mtime, size, folder_rank, model_id FROM lm_files")}
+    stored_serials = defaultdict(set)
+    for serial, path in conn.execute("SELECT serial_no, path FROM lm_serials"):
+        stored_serials[path].add(serial)
+
+    problems = 0
+    for path, stats in sorted(seen.items()):
+        if path not in stored:
+            console.warning(f"Missing from index: {path}")
+        elif stored[path][:3] != stats:
+            console.warning(f"Stale in index (file changed): {path}")
+        else:
+            try:
+                model_id, serials = read_lm_file(path)
+            except Exception as e:
+                console.warning(f"Unreadable LM file: {path} ({e})")
+            else:
+                if model_id == stored[path][3] and set(serials) == stored_serials[path]:
+                    continue
+                console.warning(f"Index content differs from file: {path}")
+        problems += 1
+
+    for path, stats in sorted(stored.items()):
+        if path not in seen and stats[2] not in failed_ranks:
+            console.warning(f"Indexed file no longer exists: {path}")
+            problems += 1
+
+    console.info(f"Checked {len(seen)} LM files against the index: {problems} problem(s) found.")
+    return problems
+
+# Skipped-file retry queue (skip_queue table): CSVs whose panel was not in the laser marking data, keyed by
+# panel serial with first-seen time and attempt count. A queued CSV is read again only once its serial is in
+# the laser marking index or its backoff timer expired. Resolving a panel deletes its records; the
+# Skipped_Logs files are an append-only history written when a CSV is first queued
+
+# Function to queue a skipped CSV or count another attempt - returns True when it was newly queued
+def queue_skipped_file(csv_name, serial_no):
+    now = time.time()
+    conn = get_state_db()
+    row = conn.execute("SELECT attempts FROM skip_queue WHERE csv_file = ?", (csv_name,)).fetchone()
+    attempts = row[0] + 1 if row else 1
+    delay = min(settings["Skip_Retry_Base_Seconds"] * 2 ** (attempts - 1), settings["Skip_Retry_Max_Seconds"])
+    with conn:
+        if row:
+            conn.execute("UPDATE skip_queue SET serial_no = ?, attempts = ?, last_attempt = ?, next_attempt = ? WHERE csv_file = ?",
+                         (serial_no, attempts, now, now + delay, csv_name))
+        else:
+            conn.execute("INSERT INTO skip_queue (csv_file, serial_no, first_seen, attempts, last_attempt, next_attempt) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", (csv_name, serial_no, now, attempts, now, now + delay))
+    return row is None
+
+# Function to remove a panel's CSVs from the skipped-file retry queue once its serial is found
+def resolve_skipped_panel(serial_no):
+    conn = get_state_db()
+    with conn:
+        removed = conn.execute("DELETE FROM skip_queue WHERE serial_no = ?", (serial_no,)).rowcount
+    if removed:
+        logging.debug("Removed %s from the skipped-file queue.", serial_no)
+
+# Helper function to keep the CSV names that are not queued (queued: csv_file -> (serial_no, next_attempt)),
+# or whose panel is now in the laser marking index, or whose retry time has come
+def filter_due_csv_files(csv_names, queued):
+    now = time.time()
+    selected = []
+    for name in csv_names:
+        entry = queued.get(name)
+        if entry is None or entry[1] <= now or lookup_lm_serial(entry[0]):
+            selected.append(name)
+    return selected
+
+# Function to pick the Scan_Folder CSVs to parse this cycle: everything not queued, plus queued CSVs whose
+# panel is now in the laser marking index or whose retry time has come. Forgets queued CSVs that are gone
+def select_csv_files_to_parse(csv_names):
+    conn = get_state_db()
+    queued = {row[0]: (row[1], row[2]) for row in conn.execute("SELECT csv_file, serial_no, next_attempt FROM skip_queue")}
+    if not queued:
+        return list(csv_names)
+
+    present = set(csv_names)
+    gone = [name for name in queued if name not in present]
+    if gone:
+        with conn:
+            conn.executemany("DELETE FROM skip_queue WHERE csv_file = ?", [(name,) for name in gone])
+
+    selected = filter_due_csv_files(csv_names, queued)
+    waiting = len(csv_names) - len(selected)
+    if waiting:
+        logging.info(f"{waiting} skipped file(s) wait for laser marking data or their retry time.")
+    return selected
+
+
+# Columns of the AOI CSV export that make up a pre_aoi record, in record tuple order
+CSV_RECORD_COLUMNS = ('Board serial number', 'Model', 'Top', 'Result(Operator Confirmation)', 'Inspection start', 'Inspection end')
+
+# Helper function to resolve the record columns' positions from the CSV header. A repeated header name uses
+# its last column, like csv.DictReader. Returns an itemgetter for full rows and the first missing column
+def csv_record_getter(header):
+    header_index = {name: i for i, name in enumerate(header)}
+    positions = [header_index.get(column) for column in CSV_RECORD_COLUMNS]
+    missing = next((column for column, position in zip(CSV_RECORD_COLUMNS, positions) if position is None), None)
+    if missing is not None:
+        return None, missing
+    return operator.itemgetter(*positions), None
+
+# Per-file parse work: CSV reading, laser marking lookup and record building. It doesn't touch logs or staging
+# buffers, so it can run in a worker process; stage_parsed_csv applies the result in the main process.
+# The file is streamed with csv.reader: the first row is enough for the lookup, so skipped panels are not read
+# any further. rows are (serial_no, model, top, result, inspection_start, inspection_end, ng) tuples.
+# timings holds the stage durations measured here (a worker process can't record metrics itself)
+def read_csv_for_staging(csv_file):
+    started = time.perf_counter()
+    result = {"csv_file": csv_file, "panel_barcode": None, "found": False, "model_id": None,
+              "lm_file": None, "rows": None, "error": None, "timings": {}}
     try:
-        print("Parser Begins")
-        
-        # Load serial number from the CSV file
         with open(csv_file, 'r') as file:
-            reader = csv.DictReader(file)
-            rows = list(reader)
-            if not rows:
-                logging.error(f"No data found in {csv_file}")
-                return
-            
-            panel_barcode = rows[0]['Board serial number']  # Assuming first serial_no for lookup
-            print(panel_barcode)
-    
-        if not panel_barcode:
-            print("No serial number found in CSV")
-            logging.error(f"panel_barcode not found in {csv_file}")
-            return
-    
-        # Get model_id dynamically from JSON file matching serial_no
-        model_id, found = check_panel_barcode_in_json(panel_barcode, json_folder1, json_folder2, skipped_log_folder)
-        if found:
-            logging.info(f"Found serial_no {panel_barcode} in JSON files with model_id {model_id}. Proceeding with parsing.")
-            print("Found in LM")
+            # As in csv.DictReader, the first line is the header and blank lines after it are skipped
+            reader = csv.reader(file)
+            header = next(reader, None)
+            rows = (row for row in reader if row)
+            first_row = next(rows, None) if header is not None else None
+            if first_row is None:
+                return result
+
+            header_index = {name: i for i, name in enumerate(header)}
+            if 'Board serial number' not in header_index:
+                raise KeyError('Board serial number')
+            serial_position = header_index['Board serial number']
+            # Short rows read as None for the missing fields, like csv.DictReader
+            panel_barcode = first_row[serial_position] if serial_position < len(first_row) else None
+            result["panel_barcode"] = panel_barcode
+
+            if not panel_barcode:
+                return result
+
+            # Get model_id dynamically from the laser marking index
+            lookup_started = time.perf_counter()
+            match = lookup_lm_serial(panel_barcode)
+            result["timings"]["lm_lookup"] = time.perf_counter() - lookup_started
+            if not match:
+                return result
+            result["found"] = True
+            result["model_id"], result["lm_file"] = match
+
+            get_record, missing = csv_record_getter(header)
+            if missing is not None:
+                raise KeyError(missing)
+            width = len(header)
+
             ng_count = 0
-            existing_data, last_pd_no = load_existing_json(json_file)
-            
-            # Prepare JSON data for pre_aoi
-            pre_aoi_data = existing_data.get("pre_aoi", [])
-            for row in rows:
-                serial_no = row['Board serial number']
-                model = row['Model']
-                top = row['Top']
-                result = row['Result(Operator Confirmation)']
-                inspection_start = row['Inspection start']
-                inspection_end = row['Inspection end']
-                last_pd_no = generate_pd_no(last_pd_no) 
-                
-                if result.lower() != 'pass':
-                    ng_count = ng_count_log(csv_file) # Get ng count
-
-                # Parse each row and add relevant fields to a dictionary
-                record = {
-                    'serial_no': serial_no,
-                    'model': model,
-                    'top': top,
-                    'result': result,
-                    'inspection_start': inspection_start,
-                    'inspection_end': inspection_end,
-                    'pd_no': last_pd_no,
-                    'ng': ng_count
-                }
-                pre_aoi_data.append(record)
-    
-            # Final structured data
-            final_data = {
-                "model_id": model_id,
-                "pre_aoi": pre_aoi_data
-            }
-            
-            # Append to the existing JSON file
-            with open(json_file, 'w') as json_output:
-                json.dump(final_data, json_output, indent=4)
-    
-            logging.info(f"Data from {csv_file} has been parsed and saved to {json_file}")
-            print(f"Data from {csv_file} has been parsed and saved to {json_file}")
-    
-            log_parsed_file(log_file, csv_file)
-    
-        else:
-            logging.info(f"serial_no {panel_barcode} not found in any JSON files. Skipping this file.")
-            log_skipped_file(skipped_log_file, csv_file)
-    
+            file_ng_count = None
+            records = []
+            for row in itertools.chain((first_row,), rows):
+                if len(row) >= width:
+                    record = get_record(row)
+                else:
+                    record = get_record(row + [None] * (width - len(row)))
+
+                if record[3].lower() != 'pass':
+                    # Same count for every NG row of the file, so look it up once
+                    if file_ng_count is None:
+                        ng_started = time.perf_counter()
+                        file_ng_count = ng_count_log(csv_file)
+                        result["timings"]["ng_count"] = time.perf_counter() - ng_started
+                    ng_count = file_ng_count
+
+                records.append(record + (ng_count,))
+        result["rows"] = records
     except Exception as e:
-        logging.error(f"Error parsing CSV file {csv_file}: {e}")
-        print(f"Error parsing CSV file {csv_file}: {e}")
+        result["error"] = str(e)
+    finally:
+        result["timings"]["parse_file"] = time.perf_counter() - started
+    return result
+
+# Apply one read_csv_for_staging result: skipped logs, pd_no numbering, staging and parser logs.
+# Results are applied in Scan_Folder listing order, so the outcome is the same as a serial run.
+# Returns "parsed", "skipped" or None (nothing usable in the file)
+def stage_parsed_csv(result, json_file, log_file, skipped_log_file):
+    csv_file = result["csv_file"]
+    for stage, seconds in result["timings"].items():
+        observe_stage(stage, seconds)
+    if result["error"] and not result["found"]:
+        console.error(f"Error parsing CSV file {csv_file}: {result['error']}")
+        return
+
+    panel_barcode = result["panel_barcode"]
+    if panel_barcode is None:
+        logging.error(f"No data found in {csv_file}")
+        return
+    console.debug("Parsing %s (panel %s)", csv_file, panel_barcode)
+
+    if not panel_barcode:
+        console.error(f"panel_barcode not found in {csv_file}")
+        return
+
+    if not result["found"]:
+        logging.debug("serial_no %s not found in any JSON files. Skipping this file.", panel_barcode)
+        if queue_skipped_file(os.path.basename(csv_file), panel_barcode):
+            log_skipped_file(skipped_log_file, csv_file)
+        return "skipped"
+
+    console.debug("Match found in file: %s", result["lm_file"])
+    # The panel is known now - drop it from the skipped-file retry queue
+    resolve_skipped_panel(panel_barcode)
+
+    if result["error"]:
+        console.error(f"Error parsing CSV file {csv_file}: {result['error']}")
+        return
+
+    model_id = result["model_id"]
+    logging.debug("Found serial_no %s in JSON files with model_id %s. Proceeding with parsing.", panel_barcode, model_id)
+    staged = get_staging_buffer(json_file)
+    pd_numbers = allocate_pd_numbers(len(result["rows"]))
+
+    pre_aoi_data = []
+    for pd_no, (serial_no, model, top, row_result, inspection_start, inspection_end, ng_count) in zip(pd_numbers, result["rows"]):
+        pre_aoi_data.append({
+            'serial_no': serial_no,
+            'model': model,
+            'top': top,
+            'result': row_result,
+            'inspection_start': inspection_start,
+            'inspection_end': inspection_end,
+            'pd_no': pd_no,
+            'ng': ng_count
+        })
+
+    # Append to the staged data; flush_staging_json writes the JSON file once per cycle
+    staged["model_id"] = model_id
+    staged["pre_aoi"].extend(pre_aoi_data)
+    count_metric("paoi_records_parsed_total", len(pre_aoi_data))
+
+    console.debug("Data from %s has been parsed and staged for %s", csv_file, json_file)
+
+    log_parsed_file(log_file, csv_file)
+    return "parsed"
+
+# Parse worker processes, started on first use and kept for later cycles. Workers are spawned rather than
+# forked, so they don't inherit the scheduler's threads, locks or SQLite connections. Lines share the pool, so it
+# is created and replaced under parse_pool_lock
+parse_pool = None
+parse_pool_lock = threading.Lock()
+
+# Function run in a parse worker for one CSV file of a line - the main process has already imported the line's copy logs
+def read_csv_for_line(csv_file, line):
+    copy_ledger_imported.add(line["log_folders"]["Copy_Logs"])
+    with line_context(line):
+        return read_csv_for_staging(csv_file)
+
+# Helper function to get the parse worker pool (shared by all lines)
+def get_parse_pool():
+    global parse_pool
+    with parse_pool_lock:
+        if parse_pool is None:
+            parse_pool = ProcessPoolExecutor(max_workers=settings["Parse_Workers"], mp_context=multiprocessing.get_context("spawn"))
+        return parse_pool
+
+# Helper function to drop a broken parse pool (its other workers would otherwise linger); the next cycle starts a
+# new one. Does nothing if another line has replaced it already
+def discard_parse_pool(pool):
+    global parse_pool
+    with parse_pool_lock:
+        if parse_pool is not pool:
+            return
+        parse_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+# Function to parse a cycle's CSV files into the staging buffer of json_file. Files are read in parallel when
+# Parse_Workers > 1 and there are at least Parse_Parallel_Min_Files of them; results are applied in order.
+# Returns the sets of parsed and skipped file names, which the backup stage works from
+@timed_stage("parse")
+def parse_csv_files(csv_files, json_file, log_file, skipped_log_file):
+    workers = settings["Parse_Workers"]
+    results = None
+    if workers > 1 and len(csv_files) >= settings["Parse_Parallel_Min_Files"]:
+        pool = None
+        try:
+            # Workers take the NG counters as they are, so bring in any new copy logs first
+            if line_log_folders()["Copy_Logs"] not in copy_ledger_imported:
+                import_copy_logs_into_ledger(line_log_folders()["Copy_Logs"])
+            chunksize = max(1, len(csv_files) // (workers * 4))
+            pool = get_parse_pool()
+            results = list(pool.map(read_csv_for_line, csv_files, itertools.repeat(get_current_line()), chunksize=chunksize))
+        except Exception as e:
+            # Parse this batch serially. Only a broken pool (e.g. a worker died) is replaced - any other error leaves
+            # it to the other lines still mapping on it
+            logging.error(f"Parallel parsing failed, parsing serially: {e}")
+            if isinstance(e, BrokenExecutor):
+                discard_parse_pool(pool)
+    if results is None:
+        results = map(read_csv_for_staging, csv_files)
+
+    parsed_files = set()
+    skipped_files = set()
+    for result in results:
+        try:
+            status = stage_parsed_csv(result, json_file, log_file, skipped_log_file)
+        except Exception as e:
+            console.error(f"Error parsing CSV file {result['csv_file']}: {e}")
+            continue
+        if status == "parsed":
+            parsed_files.add(os.path.basename(result["csv_file"]))
+        elif status == "skipped":
+            skipped_files.add(os.path.basename(result["csv_file"]))
+    count_metric("paoi_files_parsed_total", len(parsed_files))
+    count_metric("paoi_files_skipped_total", len(skipped_files))
+    if csv_files:
+        console.info(f"{line_label()}Parsed {len(parsed_files)} of {len(csv_files)} CSV file(s) into {json_file}; {len(skipped_files)} skipped")
+    return parsed_files, skipped_files
+
+# Staging buffers: per JSON_Data_Folder file, the data parsed this cycle. stage_parsed_csv appends to the
+# buffer and flush_staging_json writes the file once, instead of re-reading and rewriting it for every CSV
+staging_buffers = {}
+
+# Helper function to get the staging buffer of a JSON file, starting from the file's current content
+def get_staging_buffer(json_file):
+    staged = staging_buffers.get(json_file)
+    if staged is None:
+        existing_data, _ = load_existing_json(json_file)
+        staged = {
+            "model_id": existing_data.get("model_id", ""),
+            "pre_aoi": existing_data.get("pre_aoi", [])
+        }
+        staging_buffers[json_file] = staged
+    return staged
+
+# Function to write a staging buffer to its JSON file. Written to a temporary file and renamed, so the
+# uploader never reads a half-written file. Compact unless Staging_JSON_Pretty is set
+def flush_staging_json(json_file):
+    staged = staging_buffers.pop(json_file, None)
+    if staged is None:
+        return False
+
+    final_data = {
+        "model_id": staged["model_id"],
+        "pre_aoi": staged["pre_aoi"]
+    }
+    temp_file = json_file + ".tmp"
+    with open(temp_file, 'w') as json_output:
+        if settings["Staging_JSON_Pretty"]:
+            json.dump(final_data, json_output, indent=4)
+        else:
+            json.dump(final_data, json_output, separators=(',', ':'))
+        json_output.flush()
+        os.fsync(json_output.fileno())
+    os.replace(temp_file, json_file)
+    logging.info(f"Wrote {len(final_data['pre_aoi'])} records to {json_file}")
+    return True
 
 # Helper function to load existing JSON data - Parser
 def load_existing_json(json_file):
     # Check if the JSON file exists and is not empty
     if not os.path.exists(json_file) or os.path.getsize(json_file) == 0:
-        print(f"File {json_file} is empty or doesn't exist. Creating a new file with empty data.")
-        # Initialize empty structure for new data
+        console.debug("File %s is empty or doesn't exist. Starting with empty data.", json_file)
+        # Initialize empty structure for new data; the file is written by flush_staging_json
         data = {"model_id": "", "pre_aoi": []}
-        with open(json_file, 'w') as f:
-            json.dump(data, f, indent=4)
         return data, "PD0000"  # Return initialized data and default PD number
 
     try:
@@ -388,12 +1424,60 @@ def load_existing_json(json_file):
         logging.error(f"Unexpected error while reading {json_file}: {e}")
         return {"model_id": "", "pre_aoi": []}, "PD0000"
 
-# Helper function to generate a new PD number
-def generate_pd_no(last_pd_no):
-    # Increment last pd_no to generate a new one
-    last_number = int(last_pd_no[2:])  # Strip off the 'PD' prefix
-    new_number = last_number + 1
-    return f"PD{new_number:04d}"
+# PD number allocator. Numbers come from one counter in the state database (pd_allocator table) and are
+# reserved PD_Block_Size at a time, so they are unique across JSON files and restarts without per-row I/O.
+# A crash only leaves a gap (the rest of the reserved block), never a duplicate
+pd_allocator_lock = threading.Lock()
+pd_block = [0, 0]  # [next, end) of the numbers reserved by this process
+
+# Helper function to format a PD number. Numbers wider than PD_Number_Width just grow longer
+def format_pd_no(number):
+    return f"PD{number:0{settings['PD_Number_Width']}d}"
+
+# Helper function to find the highest pd_no already written on any line, to seed a new allocator past it
+def highest_pd_no_in_folders():
+    highest = 0
+    for folder in [line["folders"][name] for line in lines for name in ("JSON_Data_Folder", "Done_Folder")]:
+        for json_file in os.listdir(folder):
+            if not json_file.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(folder, json_file), 'r') as f:
+                    data = json.load(f)
+                for record in data.get("pre_aoi", []):
+                    pd_no = str(record.get("pd_no", ""))
+                    if pd_no[2:].isdigit():
+                        highest = max(highest, int(pd_no[2:]))
+            except Exception as e:
+                logging.error(f"Error reading pd_no values from {json_file}: {e}")
+    return highest
+
+# Function to reserve count PD numbers in the state database - returns the first one
+def reserve_pd_numbers(count):
+    conn = get_shared_state_db()
+    if conn.execute("SELECT 1 FROM pd_allocator WHERE name = 'pd_no'").fetchone() is None:
+        seed = highest_pd_no_in_folders() + 1
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO pd_allocator (name, next_no) VALUES ('pd_no', ?)", (seed,))
+        logging.info(f"PD number allocator started at {format_pd_no(seed)}.")
+    with conn:
+        conn.execute("UPDATE pd_allocator SET next_no = next_no + ? WHERE name = 'pd_no'", (count,))
+        end = conn.execute("SELECT next_no FROM pd_allocator WHERE name = 'pd_no'").fetchone()[0]
+    return end - count
+
+# Function to hand out count new PD numbers, reserving another block when this process's block runs out
+def allocate_pd_numbers(count):
+    numbers = []
+    with pd_allocator_lock:
+        while len(numbers) < count:
+            if pd_block[0] == pd_block[1]:
+                block_size = max(settings["PD_Block_Size"], count - len(numbers))
+                start = reserve_pd_numbers(block_size)
+                pd_block[:] = [start, start + block_size]
+            take = min(count - len(numbers), pd_block[1] - pd_block[0])
+            numbers.extend(range(pd_block[0], pd_block[0] + take))
+            pd_block[0] += take
+    return [format_pd_no(number) for number in numbers]
 
 # Helper function to log parsed CSV files
 def log_parsed_file(log_file, csv_file):
@@ -406,38 +1490,29 @@ def log_skipped_file(skipped_log_file, csv_file):
         skipped_log.write(f"Skipped {csv_file}\n")
 
 
-# Count NG value for Board
+# Count NG value for Board - number of copy log entries for its serial, read from the NG counters kept with the
+# copy ledger. Entries count by their serial prefix: unlike the old scan of the logs for the serial anywhere in the
+# line, ABC1 no longer counts ABC12_... files. That keeps the lookup a single primary-key read however long the
+# copy history gets; AOI file names start with the board serial, so real serials count the same
 def ng_count_log(csv_file):
+    copy_log_folder = line_log_folders()["Copy_Logs"]
     try:
-        # Dynamically get the folder path for "Copy_Logs"
-        copy_log_folder = os.path.dirname(get_log_file_path("Copy_Logs", datetime.now().strftime('%Y-%m-%d')))
-        
+        # Make sure copy logs written by older versions are counted
+        if copy_log_folder not in copy_ledger_imported:
+            import_copy_logs_into_ledger(copy_log_folder)
+
         # Extract serial number from csv_file
         filename = os.path.basename(csv_file)
         serial_no = filename.split('_')[0]  # Serial number is the part before the first underscore
 
-        # Initialize count for the serial number
-        serial_count = 0
-        
-        # Define the file pattern for log files (e.g., copy_logs_YYYY-MM-DD.log)
-        log_file_pattern = r"^copy_logs_\d{4}-\d{2}-\d{2}\.log$"
-
-        # Loop over each file in the directory
-        for log_file_name in os.listdir(copy_log_folder):
-            # Only process files that match the log file pattern
-            if re.match(log_file_pattern, log_file_name):
-                log_file_path = os.path.join(copy_log_folder, log_file_name)
-                
-                # Read the file and count occurrences of the serial number
-                with open(log_file_path, 'r') as log_file:
-                    log_lines = log_file.readlines()
-                    serial_count += sum(1 for line in log_lines if serial_no in line)
+        row = get_state_db().execute("SELECT count FROM ng_counts WHERE serial_no = ?", (serial_no,)).fetchone()
+        serial_count = row[0] if row else 0
 
         # Log and return the count of occurrences
         if serial_count > 0:
-            logging.info(f"Serial number {serial_no} found {serial_count} times in copy log files.")
+            logging.debug("Serial number %s found %s times in copy log files.", serial_no, serial_count)
         else:
-            logging.info(f"Serial number {serial_no} not found in any copy log file.")
+            logging.debug("Serial number %s not found in any copy log file.", serial_no)
         
         return serial_count
 
@@ -472,21 +1547,188 @@ def load_existing_json_2(json_file):
 
 
 
+# Shared HTTP client for every ERP call: one pooled keep-alive session, default timeouts and cached auth headers
+erp_session = None
+erp_session_lock = threading.Lock()
+erp_headers_cache = {}
+erp_request_counts = Counter()
+
+# Helper function to get (or create) the pooled ERP session
+def get_erp_session():
+    global erp_session
+    with erp_session_lock:
+        if erp_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=settings["ERP_Pool_Size"])
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            erp_session = session
+        return erp_session
+
+# Helper function to build the ERP auth headers once per API key
+def get_erp_headers(api_key, api_secret):
+    headers = erp_headers_cache.get((api_key, api_secret))
+    if headers is None:
+        headers = {
+            "Authorization": f"token {api_key}:{api_secret}",
+            "Content-Type": "application/json"
+        }
+        erp_headers_cache[(api_key, api_secret)] = headers
+    return headers
+
+# Circuit breaker shared by all ERP calls. closed: requests go out. open: requests fail at once (ERPCircuitOpen)
+# until probe_at. half_open: requests go out as probes - the first success closes the circuit, a failure opens it
+# again with twice the wait (plus jitter), up to ERP_Breaker_Max_Seconds
+erp_breaker = {"state": "closed", "failures": 0, "trips": 0, "probe_at": 0.0}
+erp_breaker_lock = threading.Lock()
+
+class ERPCircuitOpen(requests.exceptions.ConnectionError):
+    pass
+
+# Helper function to check whether ERP requests may go out now (moves an open circuit to half_open once its wait is over)
+def erp_breaker_allows():
+    with erp_breaker_lock:
+        if erp_breaker["state"] != "open":
+            return True
+        if time.monotonic() >= erp_breaker["probe_at"]:
+            erp_breaker["state"] = "half_open"
+            logging.info("ERP circuit half-open; probing the server.")
+            return True
+        return False
+
+# Helper function to check whether uploads are parked, without using up a probe
+def is_erp_circuit_open():
+    with erp_breaker_lock:
+        return erp_breaker["state"] == "open" and time.monotonic() < erp_breaker["probe_at"]
+
+# Helper function to record a request that reached the ERP server
+def record_erp_success():
+    with erp_breaker_lock:
+        if erp_breaker["state"] != "closed":
+            logging.info("ERP server reachable again; circuit closed.")
+        erp_breaker.update(state="closed", failures=0, trips=0)
+
+# Helper function to record a connection error or 5xx - opens the circuit after ERP_Breaker_Failures in a row,
+# or at once when a probe fails
+def record_erp_failure():
+    with erp_breaker_lock:
+        if erp_breaker["state"] == "open":
+            return  # A request that was already in flight when the circuit opened
+        erp_breaker["failures"] += 1
+        if erp_breaker["state"] == "half_open" or erp_breaker["failures"] >= settings["ERP_Breaker_Failures"]:
+            wait = min(settings["ERP_Breaker_Base_Seconds"] * 2 ** erp_breaker["trips"], settings["ERP_Breaker_Max_Seconds"])
+            wait = random.uniform(wait / 2, wait)
+            erp_breaker.update(state="open", probe_at=time.monotonic() + wait)
+            erp_breaker["trips"] += 1
+            logging.warning(f"ERP circuit open; uploads parked for {wait:.0f} seconds.")
+
+# Helper function to wait before retrying an ERP request: short exponential backoff with jitter, capped at delay.
+# Returns False (without waiting) once the circuit is open - the caller should give up and leave it to the outbox
+def wait_before_erp_retry(attempt, delay):
+    if is_erp_circuit_open():
+        return False
+    count_metric("paoi_erp_retries_total")
+    time.sleep(random.uniform(0.5, 1.0) * min(delay, 2 ** (attempt - 1)))
+    return True
+
+# Function to send one request to the ERP server over the pooled session
+def erp_request(method, url, timeout=None, **kwargs):
+    if timeout is None:
+        timeout = (settings["ERP_Connect_Timeout"], settings["ERP_Read_Timeout"])
+    elif not isinstance(timeout, tuple):
+        timeout = (min(settings["ERP_Connect_Timeout"], timeout), timeout)
+    if not erp_breaker_allows():
+        raise ERPCircuitOpen(f"ERP circuit open; {method} {url} not sent")
+    try:
+        response = get_erp_session().request(method, url, timeout=timeout, **kwargs)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        count_metric("paoi_erp_responses_total", method=method, status="error")
+        record_erp_failure()
+        raise
+    count_metric("paoi_erp_responses_total", method=method, status=str(response.status_code))
+    if response.status_code >= 500:
+        record_erp_failure()
+    else:
+        record_erp_success()
+    with erp_session_lock:
+        erp_request_counts[method] += 1
+    logging.debug("ERP %s %s -> %s (%.3fs)", method, url, response.status_code, response.elapsed.total_seconds())
+    return response
+
+# Function to report ERP connection reuse - requests sent, connections opened, and requests served on a kept-alive connection
+def get_erp_connection_stats():
+    with erp_session_lock:
+        session = erp_session
+        requests_sent = sum(erp_request_counts.values())
+        by_method = dict(erp_request_counts)
+    connections = 0
+    if session is not None:
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+    return {
+        "requests": requests_sent,
+        "connections": connections,
+        "reused": max(requests_sent - connections, 0),
+        "by_method": by_method,
+    }
+
+# Cache of model_id -> (parent document name, expiry time), filled by lookups and by parent POSTs. ERP answers
+# 404/417 to a GET/PUT on a parent that was deleted or renamed, which drops the entry (a 417 on a POST is a
+# validation error on the new document, not a missing parent)
+parent_cache = OrderedDict()
+parent_cache_lock = threading.Lock()
+PARENT_GONE_STATUSES = (404, 417)
+
+# Helper function to get a cached parent name - returns None when missing or expired
+def get_cached_parent_name(model_id):
+    with parent_cache_lock:
+        entry = parent_cache.get(model_id)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            del parent_cache[model_id]
+            return None
+        parent_cache.move_to_end(model_id)
+        return entry[0]
+
+# Helper function to remember the parent name of a model_id
+def cache_parent_name(model_id, parent_name):
+    ttl = settings["Parent_Cache_TTL_Seconds"]
+    if not parent_name or ttl <= 0:
+        return
+    with parent_cache_lock:
+        parent_cache[model_id] = (parent_name, time.monotonic() + ttl)
+        parent_cache.move_to_end(model_id)
+        while len(parent_cache) > max(settings["Parent_Cache_Size"], 1):
+            parent_cache.popitem(last=False)
+
+# Helper function to forget the parent name of a model_id
+def invalidate_parent_name(model_id):
+    with parent_cache_lock:
+        if parent_cache.pop(model_id, None) is not None:
+            logging.info(f"Dropped cached parent record for model_id {model_id}")
+
 # Function to check if a parent record exists for the given model_id
 def get_parent_record(model_id, api_key, api_secret, erp_url):
-    headers = {
-        "Authorization": f"token {api_key}:{api_secret}",
-        "Content-Type": "application/json"
-    }
+    parent_name = get_cached_parent_name(model_id)
+    if parent_name:
+        console.debug("Using cached parent record: %s", parent_name)
+        return parent_name
+
+    headers = get_erp_headers(api_key, api_secret)
 
     # Ensure proper URL encoding for the filter
     filters = json.dumps([["model_id", "=", model_id]])
     url = f"{erp_url}?filters={filters}"
 
-    print(f"Fetching parent record for model_id {model_id} using URL: {url}")  # Debug print
+    console.debug("Fetching parent record for model_id %s using URL: %s", model_id, url)
 
     try:
-        response = requests.get(url, headers=headers)
+        response = erp_request("GET", url, headers=headers)
         response.raise_for_status()
 
         data = response.json()
@@ -494,60 +1736,169 @@ def get_parent_record(model_id, api_key, api_secret, erp_url):
 
         if records:
             parent_name = records[0].get("name")
-            print(f"Found existing parent record: {parent_name}")
+            console.debug("Found existing parent record: %s", parent_name)
+            cache_parent_name(model_id, parent_name)
             return parent_name
         else:
-            print(f"No parent record found for model_id {model_id}")
+            console.info(f"No parent record found for model_id {model_id}")
             return None
 
     except requests.exceptions.RequestException as e:
-        print(f"Failed to retrieve parent record: {e}")
+        console.error(f"Failed to retrieve parent record: {e}")
         return None
 
 # Function to check if ERP server is reachable
 def is_erp_server_running(erp_url, retries=3, delay=5):
+    if is_erp_circuit_open():
+        console.info("ERP circuit open. Uploads are parked until the next probe.")
+        return False
     attempt = 0
     while attempt < retries:
         try:
             # Sending a HEAD request to check if server is up
-            response = requests.head(erp_url, timeout=10)
+            response = erp_request("HEAD", erp_url, timeout=10)
             response.raise_for_status()  # Will raise HTTPError for bad responses
             return True  # Server is up
         except requests.exceptions.RequestException as e:
-            print(f"Error connecting to ERP server: {e}")
-            logging.error(f"Error connecting to ERP server: {e}")
+            console.error(f"Error connecting to ERP server: {e}")
             attempt += 1
-            if attempt < retries:
-                print(f"Retrying connection in {delay} seconds...")
-                time.sleep(delay)
+            if attempt < retries and wait_before_erp_retry(attempt, delay):
+                console.info("Retrying connection...")
             else:
-                print("Max retries reached. ERP server is down.")
+                console.error("ERP server is down.")
                 return False
             
 
+# Helper function to send one ERP request with the usual retries - returns (response, last HTTP status); the
+# response is None once retries run out, or at once if the parent document a GET/PUT was for is gone
+def erp_request_with_retries(method, url, description, retries, delay, **kwargs):
+    status = None
+    for attempt in range(1, retries + 1):
+        try:
+            response = erp_request(method, url, **kwargs)
+            status = response.status_code
+            response.raise_for_status()
+            return response, status
+        except requests.exceptions.RequestException as e:
+            logging.error(f"{method} failed for {description} (attempt {attempt}/{retries}): {e}")
+            if status in PARENT_GONE_STATUSES and method != "POST":
+                return None, status
+            if attempt < retries and wait_before_erp_retry(attempt, delay):
+                console.info(f"Retrying {description}...")
+            else:
+                break
+    console.warning(f"Giving up on {description} for now.")
+    return None, status
+
+# Function to upsert a file's records into the model's parent document in batches - returns the parent name and
+# the records that were not sent (these go through the per-record path)
+def upsert_parent_records(child_data, model_id, parent_name, headers, erp_url, retries, delay, timeout):
+    chunk_size = max(settings["ERP_Batch_Chunk_Size"], 1)
+
+    # Collapse repeated serials within the file (later records win), as successive per-record upserts would
+    merged = {}
+    for record in child_data:
+        merged.setdefault(record["serial_no"], {}).update(record)
+    pending = list(merged.values())
+
+    if not parent_name:
+        # Create the parent with the first chunk and keep the name it was given for the rest
+        first_chunk = pending[:chunk_size]
+        payload = {
+            "model_id": model_id,
+            "serial_no": first_chunk[0].get("serial_no", ""),
+            "pre_aoi": first_chunk,
+            "docstatus": 0
+        }
+        response, _ = erp_request_with_retries("POST", erp_url, f"new parent for model_id {model_id}", retries, delay,
+                                               headers=headers, data=json.dumps(payload), timeout=timeout)
+        if response is None:
+            return parent_name, pending
+        console.info(f"Successfully submitted {len(first_chunk)} record(s) for model_id {model_id}")
+        parent_name = response.json().get("data", {}).get("name")
+        cache_parent_name(model_id, parent_name)
+        pending = pending[chunk_size:]
+        if not pending or not parent_name:
+            return parent_name, pending
+
+    url = f"{erp_url}/{parent_name}"
+    response, status = erp_request_with_retries("GET", url, f"parent {parent_name}", retries, delay, headers=headers)
+    if response is None:
+        if status in PARENT_GONE_STATUSES:
+            invalidate_parent_name(model_id)
+            parent_name = None
+        return parent_name, pending
+    existing_pre_aoi = response.json().get("data", {}).get("pre_aoi", [])
+
+    # Index the parent's child table by serial_no once (first match wins, as in the per-record path)
+    serial_index = {}
+    for position, item in enumerate(existing_pre_aoi):
+        serial_index.setdefault(item.get("serial_no"), position)
+
+    # A PUT replaces the parent's whole child table and the resource API has no way to append rows, so every PUT
+    # carries all of pre_aoi. Chunking only bounds how many new records each request adds (and how many are retried
+    # when one fails), not the payload size - keep ERP_Batch_Chunk_Size large for big parents
+    for start in range(0, len(pending), chunk_size):
+        chunk = pending[start:start + chunk_size]
+        for record in chunk:
+            position = serial_index.get(record["serial_no"])
+            if position is None:
+                serial_index[record["serial_no"]] = len(existing_pre_aoi)
+                existing_pre_aoi.append(dict(record))
+            else:
+                existing_pre_aoi[position].update(record)
+
+        payload = {"pre_aoi": existing_pre_aoi}
+        response, status = erp_request_with_retries("PUT", url, f"{len(chunk)} record(s) on parent {parent_name}", retries, delay,
+                                                    headers=headers, data=json.dumps(payload), timeout=timeout)
+        if response is None:
+            if status in PARENT_GONE_STATUSES:
+                invalidate_parent_name(model_id)
+                parent_name = None
+            return parent_name, pending[start:]
+        console.info(f"Successfully submitted {len(chunk)} record(s) to parent {parent_name}")
+    return parent_name, []
+
+# One lock per model_id: writes to the same parent document never run at the same time
+parent_locks = defaultdict(threading.Lock)
+parent_locks_guard = threading.Lock()
+
+# Helper function to get the lock of a model_id's parent document
+def get_parent_lock(model_id):
+    with parent_locks_guard:
+        return parent_locks[model_id]
+
 # Function to check if a parent record exists for the given model_id
-def send_to_erpnext(data, api_key, api_secret, erp_url, retries=3, delay=15, timeout=10):
-    logging.info("Triggered API functionality.")
+# outcomes: optional dict filled with serial_no -> None when the record was accepted, or the last error otherwise
+@timed_stage("upload")
+def send_to_erpnext(data, api_key, api_secret, erp_url, retries=3, delay=15, timeout=10, outcomes=None):
+    logging.debug("Triggered API functionality.")
     
-    headers = {
-        "Authorization": f"token {api_key}:{api_secret}",
-        "Content-Type": "application/json"
-    }
+    headers = get_erp_headers(api_key, api_secret)
     
     model_id = data.get("model_id")
     pre_aoi = data.get("pre_aoi", [])
+    if outcomes is None:
+        outcomes = {}
 
     if not model_id:
-        print("No model_id found in JSON data.")
+        console.error("No model_id found in JSON data.")
+        outcomes.update((record.get("serial_no", ""), "No model_id in JSON data") for record in pre_aoi)
         return False
     
     # Check if ERP server is reachable before proceeding
     if not is_erp_server_running(erp_url, retries=3, delay=5):
+        outcomes.update((record.get("serial_no", ""), "ERP server not reachable") for record in pre_aoi)
         return False  # Exit if the server is not reachable
 
+    with get_parent_lock(model_id):
+        return send_records_to_parent(pre_aoi, model_id, api_key, api_secret, erp_url, headers, retries, delay, timeout, outcomes)
+
+# Function to upload a file's records to the parent document of model_id (caller holds the parent lock)
+def send_records_to_parent(pre_aoi, model_id, api_key, api_secret, erp_url, headers, retries, delay, timeout, outcomes):
     # Fetch parent document based on model_id
     parent_name = get_parent_record(model_id, api_key, api_secret, erp_url)
-    logging.info(f"Parent Name: {parent_name}")
+    logging.debug("Parent Name: %s", parent_name)
 
     child_data = [{
         "serial_no": record.get("serial_no", ""),
@@ -560,19 +1911,32 @@ def send_to_erpnext(data, api_key, api_secret, erp_url, retries=3, delay=15, tim
         "ng": record.get("ng", "")
     } for record in pre_aoi]
 
+    # Batch mode: a single parent GET and one PUT per chunk; records of a chunk that failed fall back to the
+    # per-record path below
+    if settings["ERP_Batch_Upsert"] and child_data:
+        parent_name, unsent = upsert_parent_records(child_data, model_id, parent_name, headers, erp_url, retries, delay, timeout)
+        unsent_serials = {record["serial_no"] for record in unsent}
+        outcomes.update((record["serial_no"], None) for record in child_data if record["serial_no"] not in unsent_serials)
+        child_data = unsent
+        if child_data:
+            logging.warning(f"Batch upload incomplete for model_id {model_id}. Sending {len(child_data)} record(s) individually.")
+            if not parent_name:
+                parent_name = get_parent_record(model_id, api_key, api_secret, erp_url)
+
     all_successful = True  # Flag to track overall success
     
     # Process each child record individually
     for record in child_data:
         attempt = 0
         success = False  # Track success for this record
+        last_error = None
         
         while attempt < retries:
             try:
                 if parent_name:
                     # If parent exists, fetch existing child records and update
                     url = f"{erp_url}/{parent_name}"
-                    response = requests.get(url, headers=headers)
+                    response = erp_request("GET", url, headers=headers)
                     response.raise_for_status()
                     
                     existing_data = response.json()
@@ -585,12 +1949,12 @@ def send_to_erpnext(data, api_key, api_secret, erp_url, retries=3, delay=15, tim
                         # Update the existing record with the new data
                         existing_record.update(record)
                         payload = {"pre_aoi": existing_pre_aoi}
-                        response = requests.put(url, headers=headers, data=json.dumps(payload), timeout=timeout)
+                        response = erp_request("PUT", url, headers=headers, data=json.dumps(payload), timeout=timeout)
                     else:
                         # If no conflict, add the new record
                         existing_pre_aoi.append(record)
                         payload = {"pre_aoi": existing_pre_aoi}
-                        response = requests.put(url, headers=headers, data=json.dumps(payload), timeout=timeout)
+                        response = erp_request("PUT", url, headers=headers, data=json.dumps(payload), timeout=timeout)
 
                 else:
                     # If parent doesn't exist, create a new parent document (POST request)
@@ -601,41 +1965,52 @@ def send_to_erpnext(data, api_key, api_secret, erp_url, retries=3, delay=15, tim
                         "pre_aoi": [record],  # Send just the current record
                         "docstatus": 0
                     }
-                    response = requests.post(url, headers=headers, data=json.dumps(payload), timeout=timeout)
+                    response = erp_request("POST", url, headers=headers, data=json.dumps(payload), timeout=timeout)
 
                 response.raise_for_status()
 
                 if response.status_code in [200, 201]:
-                    print(f"Successfully submitted record with serial_no {record['serial_no']}")
+                    console.debug("Successfully submitted record with serial_no %s", record['serial_no'])
+                    if not parent_name:
+                        # Remember the parent just created so the next records are added to it
+                        parent_name = response.json().get("data", {}).get("name")
+                        cache_parent_name(model_id, parent_name)
                     success = True
                     break  # Exit retry loop for this record
 
             except requests.exceptions.HTTPError as err:
+                last_error = str(err)
                 if err.response.status_code == 409:
                     logging.warning(f"Conflict (409) for serial_no {record['serial_no']}. Retrying as PUT.")
+                elif err.response.status_code in PARENT_GONE_STATUSES and err.response.request.method != "POST":
+                    logging.warning(f"Parent {parent_name} not found ({err.response.status_code}) for serial_no {record['serial_no']}. Looking it up again.")
+                    invalidate_parent_name(model_id)
+                    parent_name = get_parent_record(model_id, api_key, api_secret, erp_url)
                 else:
                     logging.error(f"HTTP error for serial_no {record['serial_no']}: {err}")
                     
                 attempt += 1
-                if attempt < retries:
-                    print(f"Retrying record {record['serial_no']} in {delay} seconds...")
-                    time.sleep(delay)
+                if attempt < retries and wait_before_erp_retry(attempt, delay):
+                    console.debug("Retrying record %s...", record['serial_no'])
                 else:
-                    print(f"Max retries reached for serial_no {record['serial_no']}.")
-                    break  # Stop trying this record after max retries
+                    console.warning(f"Giving up on serial_no {record['serial_no']} for now.")
+                    break  # Stop trying this record after max retries or once the circuit is open
             except requests.exceptions.RequestException as e:
+                last_error = str(e)
                 logging.error(f"Request exception for serial_no {record['serial_no']}: {e}")
                 attempt += 1
-                if attempt < retries:
-                    print(f"Retrying record {record['serial_no']} in {delay} seconds...")
-                    time.sleep(delay)
+                if attempt < retries and wait_before_erp_retry(attempt, delay):
+                    console.debug("Retrying record %s...", record['serial_no'])
                 else:
-                    print(f"Max retries reached for serial_no {record['serial_no']}.")
+                    console.warning(f"Giving up on serial_no {record['serial_no']} for now.")
                     break
 
+        outcomes[record["serial_no"]] = None if success else (last_error or "Not accepted by ERP server")
         if not success:
             all_successful = False  # Mark overall success as False if any record fails
 
+    stats = get_erp_connection_stats()
+    logging.debug("ERP connections: %s requests over %s connections (%s reused)", stats['requests'], stats['connections'], stats['reused'])
     return all_successful
 
 #--------------------------------------------------------------------------------------Taskflow-CMD---
@@ -643,63 +2018,248 @@ def send_to_erpnext(data, api_key, api_secret, erp_url, retries=3, delay=15, tim
 def move_to_done_folder(json_file):
     try:
         if os.path.exists(json_file):  # Check if the file exists
-            done_folder = folders["Done_Folder"]
-            shutil.move(json_file, os.path.join(done_folder, os.path.basename(json_file)))
-            logging.info(f"Moved {json_file} to Done Folder.")
-            print(f"Moved {json_file} to Done Folder.")
+            done_folder = line_folders()["Done_Folder"]
+            # Never replace a file already in Done_Folder (it is the only copy of what was submitted)
+            done_file = os.path.join(done_folder, os.path.basename(json_file))
+            suffix = 1
+            while os.path.exists(done_file):
+                base_name, extension = os.path.splitext(os.path.basename(json_file))
+                done_file = os.path.join(done_folder, f"{base_name}_{suffix}{extension}")
+                suffix += 1
+            shutil.move(json_file, done_file)
+            count_metric("paoi_json_files_done_total")
+            console.info(f"Moved {json_file} to Done Folder.")
         else:
-            logging.error(f"File not found: {json_file}")
-            print(f"File not found: {json_file}")
+            console.error(f"File not found: {json_file}")
     except Exception as e:
-        logging.error(f"Error moving file to Done Folder: {e}")
-        print(f"Error moving {json_file} file to Done Folder: {e}")
+        console.error(f"Error moving {json_file} file to Done Folder: {e}")
         
 
+# Helper function to name a new JSON file of the current line - data_<date>_<time with seconds>.json, with a _N
+# suffix when a file of that name is already in JSON_Data_Folder or Done_Folder (watch mode runs cycles within a second)
+def get_new_json_file_path():
+    timestamp = datetime.now().strftime('%Y-%m-%d_%H_%M_%S')
+    file_name = f"data_{timestamp}.json"
+    suffix = 1
+    while any(os.path.exists(os.path.join(line_folders()[folder_name], file_name)) for folder_name in ("JSON_Data_Folder", "Done_Folder")):
+        file_name = f"data_{timestamp}_{suffix}.json"
+        suffix += 1
+    return os.path.join(line_folders()["JSON_Data_Folder"], file_name)
+
+# Scheduled runs and watch mode runs share a line's workflow; never let two of them overlap on the same line.
+# One lock per line, so a long cycle on one line doesn't hold up the others
+workflow_locks = defaultdict(threading.Lock)
+workflow_locks_guard = threading.Lock()
+
+# Helper function to get the workflow lock of the current line
+def get_workflow_lock():
+    with workflow_locks_guard:
+        return workflow_locks[get_current_line()["name"]]
+
 # Main task workflow with user-specified schedule frequency - CGC-2 - cmd_12.py additions for existing json file handling
-def task_workflow(api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2):
+# new_files: names reported by watch mode - only those are copied instead of scanning machine_data_folder.
+# Returns the names the copy stage held back because they were still being written
+def task_workflow(api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2, new_files=None):
+    with get_workflow_lock():
+        started = time.perf_counter()
+        try:
+            return run_task_workflow(api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2, new_files)
+        finally:
+            log_cycle_summary("serial", time.perf_counter() - started)
+
+def run_task_workflow(api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2, new_files):
     # 1. Process pending JSON files from JSON_Data_Folder first
     process_pending_json_files(api_key, api_secret, erp_url)
 
     # 2. mvf.py: Copy new files from machine_data_folder to Scan_Folder
     # copy_log_file = get_log_file_path("Copy_Logs", datetime.now().strftime('%Y-%m-%d'))
-    copy_new_files(machine_data_folder, folders["Scan_Folder"], log_folders["Copy_Logs"])
+    deferred_files = copy_new_files(machine_data_folder, line_folders()["Scan_Folder"], line_log_folders()["Copy_Logs"], new_files)
 
     # 3. psr.py: Parse csv files to JSON in Scan_Folder
-    log_file = get_log_file_path("Parser_Logs", datetime.now().strftime('%Y-%m-%d'))
-    skipped_log_file = get_log_file_path("Skipped_Logs", datetime.now().strftime('%Y-%m-%d'))
-    print(skipped_log_file)
-    json_file = os.path.join(folders["JSON_Data_Folder"], f"data_{datetime.now().strftime('%Y-%m-%d_%H_%M')}.json")
-    csv_files = [file for file in os.listdir(folders["Scan_Folder"]) if file.endswith('.csv')]
+    json_file = get_new_json_file_path()
+    cycle_files = parse_scan_folder(json_folder1, json_folder2, json_file)
+    if cycle_files is None:
+        return deferred_files
 
-    for csv_file in csv_files:
-        parse_csv_to_json(os.path.join(folders["Scan_Folder"], csv_file), json_file, log_file, 'None', json_folder1, json_folder2, skipped_log_file, log_folders["Skipped_Logs"])
-        logging.info(f"JSON file created {json_file}")
+    # 4. Process the newly created JSON file (an idle cycle parses nothing and writes none)
+    if os.path.exists(json_file):
+        process_json_file(json_file, api_key, api_secret, erp_url)
 
-    # 4. Process the newly created JSON file
-    process_json_file(json_file, api_key, api_secret, erp_url)
+    # 5. Backup: Move files to Backup_Folder - the files parsed and skipped in this cycle
+    backup_cycle_files(*cycle_files)
+
+    return deferred_files
+
+# Function to parse the CSVs waiting in Scan_Folder into json_file - returns the (parsed, skipped) CSV names,
+# or None when the JSON file could not be written
+def parse_scan_folder(json_folder1, json_folder2, json_file):
+    refresh_lm_index(json_folder1, json_folder2, max_age=settings["LM_Refresh_Min_Seconds"])
+    log_file = get_log_file_path("Parser_Logs", datetime.now().strftime('%Y-%m-%d'))
+    skipped_log_file = get_log_file_path("Skipped_Logs", datetime.now().strftime('%Y-%m-%d'))
+    # Files the copy stage has not committed to the copy ledger yet wait for the next run
+    in_flight = get_copy_in_flight(line_folders()["Scan_Folder"])
+    csv_files = [file for file in os.listdir(line_folders()["Scan_Folder"]) if file.endswith('.csv') and file not in in_flight]
+    csv_files = select_csv_files_to_parse(csv_files)
 
-    # 5. Backup: Move files to Backup_Folder
-    # Get the list of successfully parsed files from the parser log
-    successfully_parsed_files = get_successfully_parsed_files(log_file)
+    successfully_parsed_files, skipped_files = parse_csv_files([os.path.join(line_folders()["Scan_Folder"], csv_file) for csv_file in csv_files],
+                                                               json_file, log_file, skipped_log_file)
 
-    # Get the list of skipped files from the skipped log
-    skipped_files = get_skipped_files(skipped_log_file)
+    # Write everything parsed this cycle in one go. If that fails the CSVs stay in Scan_Folder for the next cycle
+    try:
+        if flush_staging_json(json_file):
+            logging.info(f"JSON file created {json_file}")
+    except Exception as e:
+        console.error(f"Error writing JSON file {json_file}: {e}")
+        return None
+    return successfully_parsed_files, skipped_files
 
+# Function to move a cycle's parsed and skipped CSVs from Scan_Folder to Backup_Folder
+def backup_cycle_files(successfully_parsed_files, skipped_files):
     # If we have successfully parsed files, move them to the backup folder
     if successfully_parsed_files:
-        print("Entered taskflow backup")
         backup_log_file = get_log_file_path("Backup_Logs", datetime.now().strftime('%Y-%m-%d'))
         # Pass skipped_files to the move_files_to_backup function
-        move_files_to_backup(folders["Scan_Folder"], folders["Backup_Folder"], backup_log_file, successfully_parsed_files, skipped_files)
+        move_files_to_backup(line_folders()["Scan_Folder"], line_folders()["Backup_Folder"], backup_log_file, successfully_parsed_files, skipped_files)
     else:
         logging.info("No successfully parsed files to move to backup.")
 
 
+# Outbox: one row per record of each JSON file in JSON_Data_Folder (pending -> sent, or failed with attempts and the
+# last error), so a retry only sends the records the ERP server has not accepted yet
+# Function to register a JSON file's records in the outbox - returns the outstanding (position, record) pairs
+def load_outbox_records(json_file, data):
+    conn = get_state_db()
+    file_name = os.path.basename(json_file)
+    pre_aoi = data.get("pre_aoi", [])
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO outbox_records (json_file, position, serial_no, state, attempts, last_error, updated_at) "
+            "VALUES (?, ?, ?, 'pending', 0, NULL, ?)",
+            [(file_name, position, record.get("serial_no", ""), now) for position, record in enumerate(pre_aoi)])
+    outstanding = {row[0] for row in conn.execute(
+        "SELECT position FROM outbox_records WHERE json_file = ? AND state != 'sent'", (file_name,))}
+    return [(position, record) for position, record in enumerate(pre_aoi) if position in outstanding]
+
+# Function to store the upload outcome of outstanding records - returns True when all of them were accepted
+def record_outbox_outcomes(json_file, outstanding, outcomes):
+    file_name = os.path.basename(json_file)
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    sent, failed = [], []
+    for position, record in outstanding:
+        error = outcomes.get(record.get("serial_no", ""), "Not sent")
+        if error is None:
+            sent.append((now, file_name, position))
+        else:
+            failed.append((error, now, file_name, position))
+    conn = get_state_db()
+    with conn:
+        conn.executemany("UPDATE outbox_records SET state = 'sent', updated_at = ? WHERE json_file = ? AND position = ?", sent)
+        conn.executemany("UPDATE outbox_records SET state = 'failed', attempts = attempts + 1, last_error = ?, updated_at = ? "
+                         "WHERE json_file = ? AND position = ?", failed)
+    count_metric("paoi_records_uploaded_total", len(sent))
+    count_metric("paoi_records_failed_total", len(failed))
+    if failed:
+        logging.warning(f"{len(failed)} record(s) of {file_name} not accepted by the ERP server; {len(sent)} sent. Only those will be retried.")
+    return not failed
+
+# Function to drop the outbox rows of a JSON file (once it is in Done_Folder, or gone)
+def clear_outbox(json_file):
+    conn = get_state_db()
+    with conn:
+        conn.execute("DELETE FROM outbox_records WHERE json_file = ?", (os.path.basename(json_file),))
+
+# Function to drop outbox rows of JSON files no longer in JSON_Data_Folder and log what is still outstanding
+def prune_outbox():
+    conn = get_state_db()
+    for (file_name,) in conn.execute("SELECT DISTINCT json_file FROM outbox_records").fetchall():
+        if not os.path.exists(os.path.join(line_folders()["JSON_Data_Folder"], file_name)):
+            clear_outbox(file_name)
+    outstanding_records, outstanding_files = conn.execute(
+        "SELECT COUNT(*), COUNT(DISTINCT json_file) FROM outbox_records WHERE state != 'sent'").fetchone()
+    if outstanding_records:
+        logging.info(f"Outbox: {outstanding_records} record(s) outstanding in {outstanding_files} JSON file(s).")
+
 # Process pending JSON files first before new ones
 def process_pending_json_files(api_key, api_secret, erp_url):
-    pending_json_files = [file for file in os.listdir(folders["JSON_Data_Folder"]) if file.endswith('.json')]
-    for json_file in sorted(pending_json_files):  # Ensuring oldest files are processed first
-        process_json_file(os.path.join(folders["JSON_Data_Folder"], json_file), api_key, api_secret, erp_url)
+    prune_outbox()
+    pending_json_files = [file for file in os.listdir(line_folders()["JSON_Data_Folder"]) if file.endswith('.json')]
+    # Ensuring oldest files are processed first
+    upload_json_files([os.path.join(line_folders()["JSON_Data_Folder"], json_file) for json_file in sorted(pending_json_files)],
+                      api_key, api_secret, erp_url)
+
+
+# Helper function to read the model_id of a JSON file (None if unreadable)
+def get_json_model_id(json_file):
+    try:
+        with open(json_file, 'r') as f:
+            return json.load(f).get("model_id")
+    except Exception as e:
+        logging.error(f"Error reading model_id from {json_file}: {e}")
+        return None
+
+# Upload workers shared by all lines; each line may use at most its Upload_Workers (from "Lines") of them at once
+upload_pool = None
+upload_pool_lock = threading.Lock()
+line_upload_slots = {}
+
+# Helper function to get the shared upload worker pool
+def get_upload_pool():
+    global upload_pool
+    with upload_pool_lock:
+        if upload_pool is None:
+            upload_pool = ThreadPoolExecutor(max_workers=max(1, settings["Upload_Workers"]), thread_name_prefix="upload")
+        return upload_pool
+
+# Helper function to get the semaphore limiting the current line's share of the upload workers
+def get_line_upload_slots():
+    line = get_current_line()
+    with upload_pool_lock:
+        slots = line_upload_slots.get(line["name"])
+        if slots is None:
+            slots = threading.BoundedSemaphore(max(1, line["upload_workers"] or settings["Upload_Workers"]))
+            line_upload_slots[line["name"]] = slots
+        return slots
+
+# Function to upload JSON files on the shared upload workers. Files are grouped by model_id: each group
+# is sent in the given order by one worker, different parents go in parallel. Returns {json_file: success}
+def upload_json_files(json_files, api_key, api_secret, erp_url):
+    if json_files and is_erp_circuit_open():
+        logging.info(f"ERP circuit open; {len(json_files)} JSON file(s) stay parked in JSON_Data_Folder.")
+        return {}
+    groups = defaultdict(list)
+    for json_file in json_files:
+        model_id = get_json_model_id(json_file)
+        # Unreadable files get a group of their own so they do not hold up anything else
+        groups[model_id if model_id is not None else ("unreadable", json_file)].append(json_file)
+
+    line = get_current_line()
+    slots = get_line_upload_slots()
+
+    def upload_group(group_files):
+        try:
+            with line_context(line):
+                return {json_file: process_json_file(json_file, api_key, api_secret, erp_url) for json_file in group_files}
+        finally:
+            slots.release()
+
+    results = {}
+    if settings["Upload_Workers"] <= 1 or len(groups) == 1:
+        for group_files in groups.values():
+            slots.acquire()
+            results.update(upload_group(group_files))
+        return results
+
+    futures = []
+    for group_files in groups.values():
+        slots.acquire()  # Waits while this line already uses its share of the workers
+        futures.append(get_upload_pool().submit(upload_group, group_files))
+    for future in as_completed(futures):
+        try:
+            results.update(future.result())
+        except Exception as e:
+            logging.error(f"Error uploading JSON files: {e}")
+    return results
 
 
 # Process each JSON file by loading its content, sending data to ERP, and moving it to Done folder
@@ -707,24 +2267,610 @@ def process_json_file(json_file, api_key, api_secret, erp_url):
     data, last_pd_no = load_existing_json_2(json_file)
     
     if data:  # Only proceed if data exists
+        if is_erp_circuit_open():
+            console.debug("ERP circuit open. %s stays parked in JSON_Data_Folder.", os.path.basename(json_file))
+            return False
+
+        # Send only the records the outbox does not have as sent yet
+        outstanding = load_outbox_records(json_file, data)
         all_successful = True
 
-        success = send_to_erpnext(data, api_key, api_secret, erp_url)
-        if not success:
-            all_successful = False
+        if outstanding:
+            outcomes = {}
+            send_to_erpnext(dict(data, pre_aoi=[record for _, record in outstanding]), api_key, api_secret, erp_url, outcomes=outcomes)
+            all_successful = record_outbox_outcomes(json_file, outstanding, outcomes)
 
         if all_successful:
-            print("Moved to done!")  # Change for confirmation message
             move_to_done_folder(json_file)
+            clear_outbox(json_file)
         return all_successful
     else:
-        print("No data found to process in the JSON file.")
+        console.warning(f"No data found to process in {json_file}.")
         return False
 
 # Helper function to get log file path for different operations
 def get_log_file_path(log_type, date_str):
-    print("Getting log files")
-    return os.path.join(log_folders[log_type], f"{log_type.lower()}_{date_str}.log")
+    return os.path.join(line_log_folders()[log_type], f"{log_type.lower()}_{date_str}.log")
+
+
+#--------------------------------------------------------------------------------------Pipeline---
+# Pipeline mode: copy, parse and upload each run on their own thread and hand work on through bounded queues, so a
+# slow ERP server no longer holds up copying and parsing, and a cycle takes as long as its slowest stage instead of
+# the sum of all of them. A trigger (scheduled run or watch batch) goes copy -> parse (+ backup) -> upload; triggers
+# that pile up behind a busy stage are merged into one run of that stage. A full queue makes the stage before it
+# wait. On STOP each stage finishes what was already queued and passes the stop on. task_workflow stays as the
+# compatibility mode (Pipeline_Mode false, or --serial-workflow)
+PIPELINE_STOP = object()
+pipelines = {}  # line name -> {"running", "threads", "copy_queue", "parse_queue", "upload_queue", "busy", "full_scan"}
+
+# Helper function to get the pipeline of the current line (None when pipeline mode is off)
+def get_pipeline():
+    return pipelines.get(get_current_line()["name"])
+
+# Helper function to take everything waiting on a pipeline queue (waits for the first item). The stage counts as
+# busy from here until it calls finish_pipeline_work, after its hand-off to the next stage
+def drain_pipeline_queue(pipeline, stage_queue, stage):
+    items = [stage_queue.get()]
+    pipeline["busy"].add(stage)
+    while True:
+        try:
+            items.append(stage_queue.get_nowait())
+        except queue.Empty:
+            return items
+
+# Helper function to mark a stage as waiting for work again
+def finish_pipeline_work(pipeline, stage):
+    pipeline["busy"].discard(stage)
+
+# Function to check whether a pipeline has no work queued or in progress
+def is_pipeline_idle(pipeline):
+    return (not pipeline["busy"]
+            and all(pipeline[name].empty() for name in ("copy_queue", "parse_queue", "upload_queue")))
+
+# Function to hand a trigger to a line's pipeline (default: the current line) - new_files: names from watch mode,
+# None for a full folder scan. Returns False when the pipeline is not running
+def submit_to_pipeline(new_files=None, line=None):
+    line = line or get_current_line()
+    pipeline = pipelines.get(line["name"])
+    if pipeline is None or not pipeline["running"]:
+        return False
+    if new_files is None:
+        try:
+            pipeline["copy_queue"].put_nowait(None)
+        except queue.Full:
+            # The queue may hold only watch-mode name lists; the copy stage picks the flag up with its next batch
+            pipeline["full_scan"] = True
+            logging.info(f"{line_label()}Pipeline busy; this scan is merged with the ones already queued.")
+    else:
+        pipeline["copy_queue"].put(list(new_files))
+    return True
+
+# Function run by the copy stage thread of a line
+def run_copy_stage(pipeline, machine_data_folder):
+    copy_queue, parse_queue = pipeline["copy_queue"], pipeline["parse_queue"]
+    line = get_current_line()
+    while True:
+        items = drain_pipeline_queue(pipeline, copy_queue, "copy")
+        stopping = PIPELINE_STOP in items
+        triggers = [item for item in items if item is not PIPELINE_STOP]
+        if pipeline["full_scan"]:
+            pipeline["full_scan"] = False
+            triggers.append(None)
+        if triggers:
+            new_files = None if any(item is None for item in triggers) else sorted(set().union(*triggers))
+            try:
+                deferred_files = copy_new_files(machine_data_folder, line_folders()["Scan_Folder"], line_log_folders()["Copy_Logs"], new_files)
+                # Files still being written are looked at again once they had time to settle
+                if deferred_files and not stopping:
+                    threading.Timer(settings["Copy_Quiet_Seconds"], submit_to_pipeline, args=(deferred_files, line)).start()
+            except Exception as e:
+                logging.error(f"{line_label()}Error in pipeline copy stage: {e}")
+            parse_queue.put(True)
+        finish_pipeline_work(pipeline, "copy")
+        if stopping:
+            parse_queue.put(PIPELINE_STOP)
+            return
+
+# Function run by the parse stage thread of a line - parses Scan_Folder into a new JSON file, then backs up the CSVs
+def run_parse_stage(pipeline, json_folder1, json_folder2):
+    parse_queue, upload_queue = pipeline["parse_queue"], pipeline["upload_queue"]
+    while True:
+        items = drain_pipeline_queue(pipeline, parse_queue, "parse")
+        stopping = PIPELINE_STOP in items
+        if any(item is not PIPELINE_STOP for item in items):
+            json_file = None
+            try:
+                # The upload stage may be working on JSON files already, so never write into an existing one
+                json_file = get_new_json_file_path()
+                cycle_files = parse_scan_folder(json_folder1, json_folder2, json_file)
+                if cycle_files is not None:
+                    backup_cycle_files(*cycle_files)
+            except Exception as e:
+                logging.error(f"{line_label()}Error in pipeline parse stage: {e}")
+            upload_queue.put(json_file)
+        finish_pipeline_work(pipeline, "parse")
+        if stopping:
+            upload_queue.put(PIPELINE_STOP)
+            return
+
+# Function run by the upload stage thread of a line - every hand-off uploads all of JSON_Data_Folder (new and parked files)
+def run_upload_stage(pipeline, api_key, api_secret, erp_url):
+    upload_queue = pipeline["upload_queue"]
+    while True:
+        items = drain_pipeline_queue(pipeline, upload_queue, "upload")
+        stopping = PIPELINE_STOP in items
+        if any(item is not PIPELINE_STOP for item in items):
+            try:
+                process_pending_json_files(api_key, api_secret, erp_url)
+                log_cycle_summary("pipeline")
+            except Exception as e:
+                logging.error(f"{line_label()}Error in pipeline upload stage: {e}")
+        finish_pipeline_work(pipeline, "upload")
+        if stopping:
+            return
+
+# Helper function to run a function for a line - used as the target of a line's threads
+def run_in_line(line, function, *args):
+    with line_context(line):
+        return function(*args)
+
+# Function to start the stage threads of every line. machine_data_folder is used for a line without its own
+def start_pipeline(api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2):
+    size = max(1, settings["Pipeline_Queue_Size"])
+    for line in lines:
+        pipeline = {"running": False, "busy": set(), "full_scan": False,
+                    "copy_queue": queue.Queue(size), "parse_queue": queue.Queue(size), "upload_queue": queue.Queue(size)}
+        thread_name = f"{line['name'] or 'line'}-"
+        pipeline["threads"] = [
+            threading.Thread(target=run_in_line, name=thread_name + "copy", daemon=True,
+                             args=(line, run_copy_stage, pipeline, line["machine_data_folder"] or machine_data_folder)),
+            threading.Thread(target=run_in_line, name=thread_name + "parse", daemon=True,
+                             args=(line, run_parse_stage, pipeline, json_folder1, json_folder2)),
+            threading.Thread(target=run_in_line, name=thread_name + "upload", daemon=True,
+                             args=(line, run_upload_stage, pipeline, api_key, api_secret, erp_url)),
+        ]
+        for thread in pipeline["threads"]:
+            thread.start()
+        pipeline["running"] = True
+        pipelines[line["name"]] = pipeline
+    console.info(f"Pipeline mode: copy, parse and upload stages started for {len(lines)} line(s).")
+
+# Function to check whether any line's pipeline is running
+def is_pipeline_running():
+    return any(pipeline["running"] for pipeline in pipelines.values())
+
+# Function to stop the pipelines - stages finish the work already queued, for up to timeout seconds.
+# Returns True when every stage finished in time
+def stop_pipeline(timeout):
+    running = [pipeline for pipeline in pipelines.values() if pipeline["running"]]
+    if not running:
+        return True
+    deadline = time.monotonic() + timeout
+    for pipeline in running:
+        pipeline["running"] = False
+        try:
+            pipeline["copy_queue"].put(PIPELINE_STOP, timeout=max(0, deadline - time.monotonic()))
+        except queue.Full:
+            logging.warning("Pipeline did not take the stop request in time.")
+    threads = [thread for pipeline in running for thread in pipeline["threads"]]
+    for thread in threads:
+        thread.join(max(0, deadline - time.monotonic()))
+    drained = not any(thread.is_alive() for thread in threads)
+    if not drained:
+        logging.warning("Pipeline stages still busy after the drain timeout; unfinished files are picked up after restart.")
+    return drained
+
+# Function run for each scheduled cycle - for every line whose previous cycle is done, hands the cycle to the
+# line's pipeline, or runs task_workflow in compatibility mode
+def run_scheduled_cycle(api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2):
+    for line in lines:
+        with line_context(line):
+            if is_cycle_running():
+                logging.info(f"{line_label()}Previous cycle still running; skipping this tick.")
+            elif not submit_to_pipeline():
+                task_workflow(api_key, api_secret, erp_url, line["machine_data_folder"] or machine_data_folder, json_folder1, json_folder2)
+
+
+#--------------------------------------------------------------------------------------Scheduler---
+# Adaptive schedule: after each tick the interval is halved while there is a backlog (CSVs waiting in Scan_Folder,
+# JSON files waiting for upload, or new files copied since the last tick) and grows by half while the line is idle,
+# within Schedule_Min_Minutes..Schedule_Max_Minutes. A tick never starts a line's cycle while its previous one is running
+schedule_state = {"minutes": 10, "copied": {}}
+
+# Helper function to count the work waiting in the lines' Scan_Folder and JSON_Data_Folder, and the files copied
+# since last asked. Work that waits for something other than the schedule doesn't count: skipped CSVs before their
+# retry, JSON files whose only unsent records already failed (retried as they come), and uploads while the circuit is open
+def measure_backlog():
+    backlog = 0
+    for line in lines:
+        with line_context(line):
+            conn = get_state_db()
+            with os.scandir(line_folders()["Scan_Folder"]) as entries:
+                csv_names = [entry.name for entry in entries if entry.name.endswith('.csv')]
+            queued = {row[0]: (row[1], row[2]) for row in conn.execute("SELECT csv_file, serial_no, next_attempt FROM skip_queue")}
+            backlog += len(filter_due_csv_files(csv_names, queued))
+            if not is_erp_circuit_open():
+                retrying = {row[0] for row in conn.execute(
+                    "SELECT json_file FROM outbox_records GROUP BY json_file "
+                    "HAVING SUM(state = 'pending') = 0 AND SUM(state = 'failed') > 0")}
+                with os.scandir(line_folders()["JSON_Data_Folder"]) as entries:
+                    backlog += sum(1 for entry in entries if entry.name.endswith('.json') and entry.name not in retrying)
+            copied = get_state_db().execute("SELECT COUNT(*) FROM copy_ledger").fetchone()[0]
+            previous = schedule_state["copied"].get(line["name"])
+            backlog += 0 if previous is None else copied - previous
+            schedule_state["copied"][line["name"]] = copied
+    return backlog
+
+# Function to work out the interval until the next tick
+def next_schedule_minutes():
+    minutes = schedule_state["minutes"]
+    if settings["Adaptive_Schedule"]:
+        if measure_backlog():
+            minutes = minutes / 2
+        else:
+            minutes = minutes * 1.5
+        minutes = min(max(minutes, settings["Schedule_Min_Minutes"]), settings["Schedule_Max_Minutes"])
+        if minutes != schedule_state["minutes"]:
+            logging.info(f"Next cycle in {minutes:.1f} minutes.")
+    schedule_state["minutes"] = minutes
+    return minutes
+
+# Function to check whether the current line's previous cycle is still running
+def is_cycle_running():
+    pipeline = get_pipeline()
+    if pipeline is not None and pipeline["running"]:
+        return not is_pipeline_idle(pipeline)
+    return get_workflow_lock().locked()
+
+# Function run by the schedule for each tick
+def run_schedule_tick(job, api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2):
+    run_scheduled_cycle(api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2)
+    # The schedule library works out the next run from job.interval after this returns
+    job.interval = max(1, round(next_schedule_minutes() * 60))
+
+# Function to schedule the cycles, starting at minutes
+def start_scheduler(minutes, api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2):
+    schedule_state["minutes"] = minutes
+    job = schedule.every(max(1, round(minutes * 60))).seconds
+    job.do(run_schedule_tick, job, api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2)
+    return job
+
+# Function to get the starting cycle interval: --interval, then Schedule_Minutes, then a prompt (10 when headless)
+def get_schedule_minutes(interval, headless):
+    if interval:
+        return interval
+    if settings["Schedule_Minutes"]:
+        return settings["Schedule_Minutes"]
+    if headless:
+        return 10
+
+    # Scheduling frequency as user input
+    schedule_freq = input("Enter the scheduling frequency in minutes: ")
+    try:
+        schedule_freq = int(schedule_freq)
+    except ValueError:
+        print("Invalid input. Setting default scheduling frequency to 10 minutes.")
+        schedule_freq = 10
+    return schedule_freq
+
+
+#--------------------------------------------------------------------------------------Watch---
+# Watch mode: react to files the AOI machine finishes writing in Machine_Data_Folder instead of waiting
+# for the next scheduled run. Uses Linux inotify (through libc, no extra package) and falls back to
+# polling the folder when inotify is unavailable. The scheduled run stays on as a safety net, e.g. for
+# network mounts that do not deliver inotify events.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+WATCH_DEBOUNCE_SECONDS = 2  # Quiet time collecting events before a batch is processed
+WATCH_POLL_SECONDS = 5  # Folder listing interval of the polling fallback
+
+# Helper function to load libc's inotify calls - returns None when inotify is not available
+def load_inotify():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    except OSError:
+        return None
+    if not (hasattr(libc, "inotify_init1") and hasattr(libc, "inotify_add_watch")):
+        return None
+    return libc
+
+# Watch a folder with inotify and call on_files with the names of closed-after-write or moved-in files
+def watch_folder_inotify(libc, folder, on_files):
+    fd = libc.inotify_init1(0)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    try:
+        if libc.inotify_add_watch(fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {folder}")
+        logging.info(f"Watching {folder} with inotify.")
+        while True:
+            buffer = os.read(fd, 64 * 1024)
+            names = []
+            offset = 0
+            while offset < len(buffer):
+                _, mask, _, name_length = INOTIFY_EVENT_HEADER.unpack_from(buffer, offset)
+                offset += INOTIFY_EVENT_HEADER.size
+                name = buffer[offset:offset + name_length].rstrip(b"\0")
+                offset += name_length
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost - let a full folder scan pick them up
+                    logging.warning(f"inotify queue overflow on {folder}. Falling back to a full scan.")
+                    names.append(None)
+                elif mask & IN_IGNORED:
+                    raise OSError(f"Watch on {folder} was removed")
+                elif name:
+                    names.append(os.fsdecode(name))
+            if names:
+                on_files(names)
+    finally:
+        os.close(fd)
+
+# Watch a folder by listing it every WATCH_POLL_SECONDS - pure Python fallback for watch_folder_inotify
+def watch_folder_polling(folder, on_files):
+    logging.info(f"Watching {folder} by polling every {WATCH_POLL_SECONDS} seconds.")
+    known = None
+    while True:
+        try:
+            with os.scandir(folder) as entries:
+                current = {entry.name for entry in entries if entry.is_file()}
+            if known is not None and current - known:
+                on_files(sorted(current - known))
+            known = current
+        except OSError as e:
+            logging.error(f"Error polling watched folder {folder}: {e}")
+        time.sleep(WATCH_POLL_SECONDS)
+
+# Function run by the watcher thread - prefers inotify and drops to polling if it cannot be used
+def watch_machine_folder(folder, event_queue):
+    def queue_files(names):
+        for name in names:
+            event_queue.put(name)
+
+    libc = load_inotify()
+    if libc is not None:
+        try:
+            watch_folder_inotify(libc, folder, queue_files)
+        except OSError as e:
+            logging.error(f"inotify watch on {folder} failed: {e}. Switching to polling.")
+    watch_folder_polling(folder, queue_files)
+
+# Helper function to put file names back on the watch queue
+def requeue_watched_files(event_queue, names):
+    for name in names:
+        event_queue.put(name)
+
+# Function run by the ingest thread - batches watched file names and feeds them through the workflow
+def ingest_watched_files(event_queue, api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2):
+    while True:
+        batch = {event_queue.get()}
+        # Wait for the burst to settle so one board's files go through in one run
+        while True:
+            try:
+                batch.add(event_queue.get(timeout=WATCH_DEBOUNCE_SECONDS))
+            except queue.Empty:
+                break
+        try:
+            if submit_to_pipeline(None if None in batch else sorted(batch)):
+                # The copy stage re-queues files still being written by itself
+                continue
+            if None in batch:
+                deferred = task_workflow(api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2)
+            else:
+                logging.info(f"{line_label()}Watch mode: processing {len(batch)} new file(s).")
+                deferred = task_workflow(api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2, sorted(batch))
+            # Files still being written are looked at again once they had time to settle
+            if deferred:
+                threading.Timer(settings["Copy_Quiet_Seconds"], requeue_watched_files, args=(event_queue, deferred)).start()
+        except Exception as e:
+            console.error(f"{line_label()}Error in watch mode workflow: {e}")
+
+# Function to start watch mode for the machine data folder (of the current line)
+def start_watch_threads(api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2):
+    event_queue = queue.Queue()
+    watcher_thread = threading.Thread(target=watch_machine_folder, args=(machine_data_folder, event_queue), daemon=True)
+    ingest_thread = threading.Thread(target=run_in_line, daemon=True,
+                                     args=(get_current_line(), ingest_watched_files, event_queue, api_key, api_secret, erp_url,
+                                           machine_data_folder, json_folder1, json_folder2))
+    watcher_thread.start()
+    ingest_thread.start()
+    console.info(f"Watch mode enabled for {machine_data_folder}")
+
+
+#--------------------------------------------------------------------------------------Archive---
+# Archiver: rolls Backup_Folder CSVs and Done_Folder JSONs older than Archive_After_Days into daily tar
+# archives (Archive_Folder/<kind>_<date>.tar.<gz|xz|zst>, by file mtime). Every file is compressed as its
+# own frame, so the archive is still a normal compressed tar, while archive_members records each file's
+# offset and length and one file can be read back without decompressing the rest. archive_serials maps
+# board serials (CSV file name prefix, pre_aoi serial_no for JSONs) to the files that hold them
+ARCHIVE_SOURCES = {"backup": "Backup_Folder", "done": "Done_Folder"}
+
+# Helper function to pick the compression for new archives
+def get_archive_compression():
+    compression = settings["Archive_Compression"]
+    if compression == "auto":
+        return "zst" if zstandard is not None else "gz"
+    if compression == "zst" and zstandard is None:
+        logging.warning("Archive_Compression is zst but the zstandard package is not installed. Using gz.")
+        return "gz"
+    return compression
+
+# Helper function to compress one archive frame
+def compress_archive_frame(data, compression):
+    if compression == "zst":
+        return zstandard.ZstdCompressor().compress(data)
+    if compression == "xz":
+        return lzma.compress(data)
+    return gzip.compress(data, mtime=0)
+
+# Helper function to decompress one archive frame
+def decompress_archive_frame(data, compression):
+    if compression == "zst":
+        return zstandard.ZstdDecompressor().decompress(data)
+    if compression == "xz":
+        return lzma.decompress(data)
+    return gzip.decompress(data)
+
+# Helper function to build the tar header and padded data of one file (no end-of-archive blocks, so daily
+# archives can be appended to)
+def build_tar_member(file_path, file_name):
+    stat = os.stat(file_path)
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    info = tarfile.TarInfo(file_name)
+    info.size = len(data)
+    info.mtime = int(stat.st_mtime)
+    info.mode = 0o644
+    padding = b"\0" * ((-len(data)) % tarfile.BLOCKSIZE)
+    return info.tobuf(format=tarfile.GNU_FORMAT) + data + padding
+
+# Helper function to find the serial numbers a Backup_Folder/Done_Folder file holds
+def get_archive_serials(kind, file_path):
+    if kind == "backup":
+        return {os.path.basename(file_path).split('_')[0]}
+    try:
+        with open(file_path, 'r') as f:
+            data = json.load(f)
+        return {record.get("serial_no") for record in data.get("pre_aoi", []) if record.get("serial_no")}
+    except Exception as e:
+        logging.error(f"Error reading serials from {file_path}: {e}")
+        return set()
+
+# Helper function to make archive_members unique per (archive, file_name), so archiving a file again after a
+# crash doesn't index it twice. Older state databases may already hold such duplicates; the first entry is kept
+def ensure_archive_member_index(conn):
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'archive_members_by_archive'").fetchone():
+        return
+    with conn:
+        duplicates = "SELECT member_id FROM archive_members WHERE member_id NOT IN (SELECT MIN(member_id) FROM archive_members GROUP BY archive, file_name)"
+        conn.execute(f"DELETE FROM archive_serials WHERE member_id IN ({duplicates})")
+        conn.execute(f"DELETE FROM archive_members WHERE member_id IN ({duplicates})")
+        conn.execute("CREATE UNIQUE INDEX archive_members_by_archive ON archive_members (archive, file_name)")
+
+# Function to archive the Backup_Folder and Done_Folder files older than Archive_After_Days
+def archive_old_files():
+    days = settings["Archive_After_Days"]
+    if days <= 0:
+        return 0
+    cutoff = time.time() - days * 86400
+    compression = get_archive_compression()
+    conn = get_shared_state_db()
+    ensure_archive_member_index(conn)
+    archived = 0
+
+    # Each line has its own Backup/Done folders; their archives share Archive_Folder, prefixed with the line name
+    for line in lines:
+        prefix = f"{line['name']}_" if line["name"] else ""
+        for kind, folder_key in ARCHIVE_SOURCES.items():
+            groups = defaultdict(list)
+            with os.scandir(line["folders"][folder_key]) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        mtime = entry.stat().st_mtime
+                        if mtime < cutoff:
+                            groups[datetime.fromtimestamp(mtime).strftime('%Y-%m-%d')].append(entry.path)
+
+            for day, file_paths in sorted(groups.items()):
+                archive_path = os.path.join(folders["Archive_Folder"], f"{prefix}{kind}_{day}.tar.{compression}")
+                # Files indexed in this archive but still on disk were archived just before a crash - only the delete is left
+                indexed = {name for (name,) in conn.execute("SELECT file_name FROM archive_members WHERE archive = ?", (archive_path,))}
+                for file_path in [path for path in file_paths if os.path.basename(path) in indexed]:
+                    os.remove(file_path)
+                    file_paths.remove(file_path)
+                    archived += 1
+                if not file_paths:
+                    continue
+
+                members = []
+                with open(archive_path, 'ab') as archive:
+                    # Anything past the last indexed frame was written by a run that crashed before indexing it
+                    # (possibly a torn frame) - cut it off; those files are still on disk and are archived again below
+                    indexed_end = conn.execute("SELECT MAX(offset + length) FROM archive_members WHERE archive = ?", (archive_path,)).fetchone()[0] or 0
+                    if archive.seek(0, os.SEEK_END) > indexed_end:
+                        logging.warning(f"Dropping {archive.tell() - indexed_end} unindexed byte(s) from the end of {archive_path}")
+                        archive.truncate(indexed_end)
+                        archive.seek(indexed_end)
+                    for file_path in sorted(file_paths):
+                        try:
+                            frame = compress_archive_frame(build_tar_member(file_path, os.path.basename(file_path)), compression)
+                        except OSError as e:
+                            logging.error(f"Error archiving {file_path}: {e}")
+                            continue
+                        offset = archive.tell()
+                        archive.write(frame)
+                        members.append((file_path, offset, len(frame)))
+                    archive.flush()
+                    os.fsync(archive.fileno())
+
+                # Index first, then delete; after a crash in between the next run finds the files indexed and only deletes them
+                archived_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                with conn:
+                    for file_path, offset, length in members:
+                        file_name = os.path.basename(file_path)
+                        conn.execute(
+                            "INSERT OR IGNORE INTO archive_members (kind, file_name, archive, offset, length, archived_at) VALUES (?, ?, ?, ?, ?, ?)",
+                            (kind, file_name, archive_path, offset, length, archived_at))
+                        member_id = conn.execute("SELECT member_id FROM archive_members WHERE archive = ? AND file_name = ?",
+                                                 (archive_path, file_name)).fetchone()[0]
+                        conn.executemany("INSERT OR IGNORE INTO archive_serials (serial_no, member_id) VALUES (?, ?)",
+                                         [(serial, member_id) for serial in get_archive_serials(kind, file_path)])
+                for file_path, _, _ in members:
+                    os.remove(file_path)
+                archived += len(members)
+                logging.info(f"Archived {len(members)} file(s) from {prefix}{folder_key} into {archive_path}")
+    return archived
+
+# Function to read one archived file back - returns (file name, content bytes)
+def read_archived_file(archive_path, offset, length):
+    compression = archive_path.rsplit('.', 1)[-1]
+    with open(archive_path, 'rb') as archive:
+        archive.seek(offset)
+        frame = archive.read(length)
+    with tarfile.open(fileobj=io.BytesIO(decompress_archive_frame(frame, compression))) as tar:
+        member = tar.next()
+        return member.name, tar.extractfile(member).read()
+
+# Function to extract archived files by board serial or file name into output_folder - returns the paths written
+def extract_archived_files(output_folder, serial_no=None, file_name=None, kind=None):
+    query = "SELECT m.kind, m.file_name, m.archive, m.offset, m.length FROM archive_members m"
+    if serial_no is not None:
+        query += " JOIN archive_serials s ON s.member_id = m.member_id WHERE s.serial_no = ?"
+        params = [serial_no]
+    else:
+        query += " WHERE m.file_name = ?"
+        params = [file_name]
+    if kind is not None:
+        query += " AND m.kind = ?"
+        params.append(kind)
+
+    os.makedirs(output_folder, exist_ok=True)
+    written = []
+    for member_kind, member_name, archive_path, offset, length in get_shared_state_db().execute(query + " ORDER BY m.member_id", params):
+        name, content = read_archived_file(archive_path, offset, length)
+        output_path = os.path.join(output_folder, name)
+        with open(output_path, 'wb') as f:
+            f.write(content)
+        written.append(output_path)
+        console.info(f"Extracted {member_kind} file {name} from {archive_path} to {output_path}")
+    return written
+
+# Function run by the archiver thread
+def run_archiver():
+    while True:
+        try:
+            archive_old_files()
+        except Exception as e:
+            logging.error(f"Error during archiving: {e}")
+        time.sleep(settings["Archive_Interval_Minutes"] * 60)
+
+# Function to start the background archiver (when Archive_After_Days is set)
+def start_archiver_thread():
+    if settings["Archive_After_Days"] > 0:
+        threading.Thread(target=run_archiver, daemon=True).start()
 
 
 # Function to reset config data for API key, API secret, ERP URL, and machine data folder
@@ -771,18 +2917,40 @@ def reset_config_file():
         print("Incorrect password. Returning to normal operation...")
         logging.info("RESET Unsuccessfull. Incorrect Password.")
 
+# Set by SIGTERM; the main loop then stops the program between scheduled runs
+stop_requested = threading.Event()
+
+# Function to stop the program once the work in progress is finished (pipeline drained, or the running
+# task_workflow done), giving up after Pipeline_Drain_Seconds
+def stop_program():
+    if is_pipeline_running():
+        console.info("Finishing the work already in the pipeline...")
+        stop_pipeline(settings["Pipeline_Drain_Seconds"])
+    else:
+        deadline = time.monotonic() + settings["Pipeline_Drain_Seconds"]
+        with workflow_locks_guard:
+            line_locks = list(workflow_locks.items())
+        for name, lock in line_locks:
+            if lock.acquire(timeout=max(0, deadline - time.monotonic())):
+                lock.release()
+            else:
+                logging.warning(f"Workflow{f' of line {name}' if name else ''} still running after the drain timeout; stopping anyway.")
+    # os._exit skips atexit, so write out the queued log records first
+    log_listener.stop()
+    os._exit(0)
+
 # Function to check for 'STOP' or 'RESET' input in a separate thread
 def control_program():
     while True:
         user_input = input("Program Started Successfully... \nType 'STOP' to exit or 'RESET' to reset configuration: ").strip().upper()
 
         if user_input == 'STOP':
-            print("Stopping program...")
+            console.info("Stopping program...")
             logging.info("Program Stopped.")
-            os._exit(0)
+            stop_program()
 
         elif user_input == 'RESET':
-            print("Resetting configuration...")
+            console.info("Resetting configuration...")
             logging.info("Reset Called.")
             reset_config_file()
 
@@ -792,13 +2960,91 @@ def start_control_thread():
     control_thread.daemon = True  # Daemon thread will not block program exit
     control_thread.start()
 
+# Command line: no arguments runs the service; subcommands run offline maintenance tasks
+def build_argument_parser():
+    parser = argparse.ArgumentParser(description="Pre-AOI data collector and ERP uploader.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    parser.add_argument("--watch", action="store_true",
+                        help="Process new machine files as soon as they are written (also: \"Watch_Mode\": true in config.json)")
+    parser.add_argument("--headless", action="store_true",
+                        help="Run unattended: no prompts and no STOP/RESET console; stop with SIGTERM (also: \"Headless\": true)")
+    parser.add_argument("--interval", type=float, metavar="MINUTES",
+                        help="Starting cycle interval in minutes (also: \"Schedule_Minutes\" in config.json)")
+    parser.add_argument("--serial-workflow", action="store_true",
+                        help="Run copy, parse and upload one after another in each cycle instead of as pipeline stages (also: \"Pipeline_Mode\": false)")
+    parser.add_argument("--debug", action="store_true",
+                        help="Log every file and record to the console and Pre_AOI_app.log (also: \"Log_Level\": \"DEBUG\")")
+    parser.add_argument("--quiet", action="store_true",
+                        help="Show only warnings and errors on the console (also: \"Quiet_Console\": true)")
+
+    lm_index_parser = subparsers.add_parser("lm-index", help="Maintain the laser marking index offline.")
+    lm_index_parser.add_argument("action", choices=["rebuild", "verify"],
+                                 help="rebuild: re-read every LM file; verify: report differences without changing the index")
+
+    archive_parser = subparsers.add_parser("archive", help="Archive old backup/done files, or extract archived files.")
+    archive_parser.add_argument("action", choices=["run", "extract"],
+                                help="run: archive files older than Archive_After_Days now; extract: restore archived files")
+    archive_parser.add_argument("--serial", help="extract: board serial number to look up")
+    archive_parser.add_argument("--file", help="extract: archived file name to look up")
+    archive_parser.add_argument("--kind", choices=sorted(ARCHIVE_SOURCES), help="extract: only raw CSVs (backup) or submitted JSONs (done)")
+    archive_parser.add_argument("--output", default=os.path.join(current_directory, "Extracted"), help="extract: output folder")
+    return parser
+
+# Function to run the archive subcommand
+def run_archive_command(args):
+    config = load_inputs_from_file()
+    if config:
+        apply_settings(config)
+        configure_lines(config, config["Machine_Data_Folder"])
+    apply_log_settings(args.debug, args.quiet)
+    if args.action == "run":
+        console.info(f"Archived {archive_old_files()} file(s).")
+        return 0
+    if not (args.serial or args.file):
+        console.error("Error: extract needs --serial or --file.")
+        return 1
+    written = extract_archived_files(args.output, serial_no=args.serial, file_name=args.file, kind=args.kind)
+    if not written:
+        console.warning("No archived files found.")
+        return 1
+    return 0
+
+# Function to run the lm-index subcommand against the LM folders in config.json
+def run_lm_index_command(args):
+    config = load_inputs_from_file()
+    if not config:
+        console.error("Error: config.json not found. Start the program once to create it.")
+        return 1
+    apply_settings(config)
+    apply_log_settings(args.debug, args.quiet)
+
+    action = args.action
+    json_folder1 = config["LM_JSON_FOLDER"]
+    json_folder2 = config["LM_BKP_JSON_FOLDER"]
+    if action == "rebuild":
+        logging.info("Laser marking index rebuild called.")
+        rebuild_lm_index(json_folder1, json_folder2)
+        return 0
+    return 1 if verify_lm_index(json_folder1, json_folder2) else 0
+
 # Main execution logic
 def main():
-    logging.info("PreAOI Program started by the user.")
+    args = build_argument_parser().parse_args()
     create_folders()
+    if args.command == "lm-index":
+        raise SystemExit(run_lm_index_command(args))
+    if args.command == "archive":
+        raise SystemExit(run_archive_command(args))
+
+    logging.info("PreAOI Program started by the user.")
 
     # Load inputs from config file if it exists, otherwise prompt user
     config = load_inputs_from_file()
+    headless = args.headless or (config or {}).get("Headless", False)
+    if not config and headless:
+        console.error("Error: config.json not found. Headless mode needs a config file (see Sample_config.json).")
+        raise SystemExit(1)
     if config:
         api_key = config["API_Key"]
         api_secret = config["API_Secret"]
@@ -806,32 +3052,57 @@ def main():
         machine_data_folder = config["Machine_Data_Folder"]
         json_folder1 = config["LM_JSON_FOLDER"]
         json_folder2 = config["LM_BKP_JSON_FOLDER"]
+        apply_settings(config)
     else:
         api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2 = get_inputs()
         write_folder_paths_to_file(api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2)
+    apply_log_settings(args.debug, args.quiet)
 
-    # Scheduling frequency as user input
-    schedule_freq = input("Enter the scheduling frequency in minutes: ")
-    try:
-        schedule_freq = int(schedule_freq)
-    except ValueError:
-        print("Invalid input. Setting default scheduling frequency to 10 minutes.")
-        schedule_freq = 10
+    # One machine folder (Machine_Data_Folder) unless config.json lists production lines under "Lines"
+    configure_lines(config, machine_data_folder)
+
+    # Reconcile the persisted laser marking index at startup; only LM files changed since the last run are read
+    refresh_lm_index(json_folder1, json_folder2)
 
-    # Schedule the task workflow at the user-defined interval
-    schedule.every(schedule_freq).minutes.do(task_workflow, api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2)
+    # Scheduling frequency as user input, unless given in config.json or on the command line
+    schedule_freq = get_schedule_minutes(args.interval, headless)
 
-    # Start a separate thread to monitor the STOP and RESET commands
-    start_control_thread()
+    # Pipeline mode: copy, parse and upload run as separate stages fed by the schedule and watch mode
+    if settings["Pipeline_Mode"] and not args.serial_workflow:
+        start_pipeline(api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2)
+
+    # Schedule the task workflow at the user-defined interval (adapted to the backlog after each cycle)
+    start_scheduler(schedule_freq, api_key, api_secret, erp_url, machine_data_folder, json_folder1, json_folder2)
+
+    # Optional watch mode: new machine files are processed within seconds of being written
+    if args.watch or settings["Watch_Mode"]:
+        for line in lines:
+            with line_context(line):
+                start_watch_threads(api_key, api_secret, erp_url, line["machine_data_folder"], json_folder1, json_folder2)
+
+    # Roll old Backup_Folder/Done_Folder files into compressed daily archives in the background
+    start_archiver_thread()
+
+    # Optional Prometheus endpoint (Metrics_Port); each cycle also writes a JSON summary line to Metrics_Logs
+    start_metrics_server()
+
+    # Start a separate thread to monitor the STOP and RESET commands; headless runs stop on SIGTERM instead
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
+    if not headless:
+        start_control_thread()
 
     # Keeps script running to execute the scheduled tasks. Catching ISR calls
     try:
-        while True:
+        while not stop_requested.is_set():
             schedule.run_pending()
             time.sleep(1)
+        console.info("Stopping program...")
+        logging.info("Program Stopped (SIGTERM).")
+        stop_program()
     except KeyboardInterrupt:
-        print("Program stopped by the user.")
+        console.info("Program stopped by the user.")
         logging.info("Program stopped by the user using Keyboard Interrupt.")
+        stop_pipeline(settings["Pipeline_Drain_Seconds"])
 
 
 if __name__ == "__main__":